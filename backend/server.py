@@ -1,36 +1,462 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Query, UploadFile, File, Form
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import socket
+import asyncio
 import logging
+import logging.handlers
+import queue
+import random
+import time
 import requests
 import json
+import csv
+import io
 import hashlib
 import secrets
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+from typing import List, Optional, Dict, Any, Callable, Awaitable, AsyncIterator
+from dataclasses import dataclass, field
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
 import uuid
 import re
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis is only needed for multi-replica deployments
+    aioredis = None
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library parser
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # Without ijson responses are decoded whole, then trimmed
+    ijson = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    socketTimeoutMS=int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '10000'))
+)
 db = client[os.environ['DB_NAME']]
 
+# Analytics and export reads go to secondaries through their own pool so
+# dashboard queries do not compete with the bot on the primary.
+# maxStalenessSeconds must be at least 90 when set.
+analytics_client = AsyncIOMotorClient(
+    os.environ.get('ANALYTICS_MONGO_URL', mongo_url),
+    readPreference='secondaryPreferred',
+    maxStalenessSeconds=int(os.environ.get('ANALYTICS_MAX_STALENESS_SECONDS', '120')),
+    maxPoolSize=int(os.environ.get('ANALYTICS_MAX_POOL_SIZE', '10')),
+    serverSelectionTimeoutMS=int(os.environ.get('ANALYTICS_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    socketTimeoutMS=int(os.environ.get('ANALYTICS_SOCKET_TIMEOUT_MS', '60000'))
+)
+analytics_db = analytics_client[os.environ['DB_NAME']]
+
 # API Configuration
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
 WEBHOOK_SECRET = os.environ['WEBHOOK_SECRET']
-USERSBOX_TOKEN = os.environ['USERSBOX_TOKEN']
+# Comma-separated pool of Usersbox keys; USERSBOX_TOKEN alone is a pool of one
+USERSBOX_TOKENS = [
+    token.strip() for token in os.environ.get('USERSBOX_TOKENS', '').split(',') if token.strip()
+] or [os.environ['USERSBOX_TOKEN']]
 USERSBOX_BASE_URL = os.environ['USERSBOX_BASE_URL']
 ADMIN_USERNAME = os.environ['ADMIN_USERNAME']
 REQUIRED_CHANNEL = os.environ['REQUIRED_CHANNEL']
 BOT_USERNAME = os.environ.get('BOT_USERNAME', 'search1_test_bot')
+# Webhook bodies above this size are rejected before parsing
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', str(1024 * 1024)))
+# Anti-flood token buckets per command class as "class=refill_per_second:burst"
+FLOOD_LIMITS = os.environ.get('FLOOD_LIMITS', 'search=0.5:3,command=1:5,callback=1:5')
+# A limited user is told about it at most once per interval
+FLOOD_NOTICE_INTERVAL_SECONDS = float(os.environ.get('FLOOD_NOTICE_INTERVAL_SECONDS', '10'))
+# Optional Redis for state shared across replicas: limits, dedup, caches and leases
+REDIS_URL = os.environ.get('REDIS_URL')
+# Key limit of the in-process state backend used when Redis is not configured
+STATE_MEMORY_MAX_KEYS = int(os.environ.get('STATE_MEMORY_MAX_KEYS', '100000'))
+# Single-flight leases expire on their own if the holder dies; waiters give up after the wait
+STATE_LEASE_SECONDS = float(os.environ.get('STATE_LEASE_SECONDS', '10'))
+STATE_LEASE_WAIT_SECONDS = float(os.environ.get('STATE_LEASE_WAIT_SECONDS', '5'))
+# Confirmed channel subscriptions are not rechecked within this window
+SUBSCRIPTION_CACHE_TTL_SECONDS = int(os.environ.get('SUBSCRIPTION_CACHE_TTL_SECONDS', '300'))
+# Telegram keeps undelivered updates for 24 hours, so remember processed ids at least that long
+UPDATE_DEDUP_TTL_SECONDS = int(os.environ.get('UPDATE_DEDUP_TTL_SECONDS', '86400'))
+# Multi-document transactions need a replica set or sharded cluster
+MONGO_USE_TRANSACTIONS = os.environ.get('MONGO_USE_TRANSACTIONS', 'false').lower() == 'true'
+RECENT_SEARCHES_KEPT = 3
+
+# Search retention Configuration
+RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'true').lower() == 'true'
+# Raw Usersbox payloads are dropped after this many days
+SEARCH_PAYLOAD_RETENTION_DAYS = int(os.environ.get('SEARCH_PAYLOAD_RETENTION_DAYS', '30'))
+# Searches are moved to searches_archive after this many days
+SEARCH_ARCHIVE_AFTER_DAYS = int(os.environ.get('SEARCH_ARCHIVE_AFTER_DAYS', '180'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '200'))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.environ.get('RETENTION_BATCH_PAUSE_SECONDS', '0.5'))
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', '3600'))
+
+# Outbox Configuration
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.environ.get('OUTBOX_POLL_INTERVAL_SECONDS', '1.0'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '1.0'))
+OUTBOX_RETRY_MAX_SECONDS = float(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', '300'))
+# Delivered messages are kept this long for auditing
+OUTBOX_DONE_TTL_SECONDS = int(os.environ.get('OUTBOX_DONE_TTL_SECONDS', str(7 * 86400)))
+
+# Dashboard stream Configuration
+# "auto" uses Mongo change streams when the deployment supports them and the
+# in-process event bus otherwise; "change_stream" and "local" force one
+DASHBOARD_EVENT_SOURCE = os.environ.get('DASHBOARD_EVENT_SOURCE', 'auto')
+DASHBOARD_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('DASHBOARD_SUBSCRIBER_QUEUE_SIZE', '256'))
+DASHBOARD_HEARTBEAT_SECONDS = float(os.environ.get('DASHBOARD_HEARTBEAT_SECONDS', '15'))
+# Dashboard read responses are reused for this long unless a write event drops them
+DASHBOARD_CACHE_TTL_SECONDS = float(os.environ.get('DASHBOARD_CACHE_TTL_SECONDS', '5'))
+
+# Bulk attempt grant Configuration
+BULK_GRANT_CHUNK_SIZE = int(os.environ.get('BULK_GRANT_CHUNK_SIZE', '500'))
+# Grant notifications are scheduled in the outbox at this many per second
+BULK_GRANT_NOTIFY_RATE = float(os.environ.get('BULK_GRANT_NOTIFY_RATE', '20'))
+# Only the holder of a grant's lease applies it; a crashed runner's lease expires after this
+BULK_GRANT_LEASE_SECONDS = int(os.environ.get('BULK_GRANT_LEASE_SECONDS', '300'))
+
+# Search job Configuration
+# Workers beyond USERSBOX_MAX_CONCURRENCY wait in the scheduler, where they are ordered fairly
+SEARCH_WORKER_CONCURRENCY = int(os.environ.get('SEARCH_WORKER_CONCURRENCY', '8'))
+SEARCH_JOB_LEASE_SECONDS = int(os.environ.get('SEARCH_JOB_LEASE_SECONDS', '120'))
+SEARCH_JOB_MAX_ATTEMPTS = int(os.environ.get('SEARCH_JOB_MAX_ATTEMPTS', '3'))
+SEARCH_JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('SEARCH_JOB_POLL_INTERVAL_SECONDS', '1.0'))
+# Finished jobs, including REST results, are kept this long
+SEARCH_JOB_TTL_SECONDS = int(os.environ.get('SEARCH_JOB_TTL_SECONDS', '86400'))
+
+# Usersbox scheduling Configuration
+# Concurrent Usersbox calls per process, sized to the Usersbox quota
+USERSBOX_MAX_CONCURRENCY = int(os.environ.get('USERSBOX_MAX_CONCURRENCY', '4'))
+# Waiting Usersbox calls beyond this are shed immediately
+USERSBOX_MAX_QUEUE = int(os.environ.get('USERSBOX_MAX_QUEUE', '200'))
+# Key selection: "least_loaded" (fewest calls in flight) or "round_robin"
+USERSBOX_KEY_STRATEGY = os.environ.get('USERSBOX_KEY_STRATEGY', 'least_loaded')
+# Per-key token bucket, sized to the Usersbox rate limit of one key
+USERSBOX_KEY_RATE_PER_SECOND = float(os.environ.get('USERSBOX_KEY_RATE_PER_SECOND', '5'))
+USERSBOX_KEY_BURST = float(os.environ.get('USERSBOX_KEY_BURST', '5'))
+# A key answering 429 rests this long unless Retry-After says otherwise
+USERSBOX_KEY_COOLDOWN_SECONDS = float(os.environ.get('USERSBOX_KEY_COOLDOWN_SECONDS', '60'))
+# Longest a call waits for any key before it is shed
+USERSBOX_KEY_MAX_WAIT_SECONDS = float(os.environ.get('USERSBOX_KEY_MAX_WAIT_SECONDS', '5'))
+# How often key balances are read from /getMe (0 disables)
+USERSBOX_BALANCE_REFRESH_SECONDS = int(os.environ.get('USERSBOX_BALANCE_REFRESH_SECONDS', '300'))
+USERSBOX_TIMEOUT_SECONDS = float(os.environ.get('USERSBOX_TIMEOUT_SECONDS', '30'))
+# Responses are decoded as a stream keeping every source's counts but only
+# the first hits of each, so memory per search stays around
+# USERSBOX_MAX_SOURCES * USERSBOX_ITEMS_PER_SOURCE items whatever Usersbox sends
+USERSBOX_ITEMS_PER_SOURCE = int(os.environ.get('USERSBOX_ITEMS_PER_SOURCE', '5'))
+USERSBOX_MAX_SOURCES = int(os.environ.get('USERSBOX_MAX_SOURCES', '100'))
+# Reading stops with an error past this many bytes
+USERSBOX_MAX_RESPONSE_BYTES = int(os.environ.get('USERSBOX_MAX_RESPONSE_BYTES', str(32 * 1024 * 1024)))
+# Circuit breaker: trips when the error or slow-call rate over the last
+# USERSBOX_BREAKER_WINDOW calls crosses its threshold, then fails fast for
+# USERSBOX_BREAKER_OPEN_SECONDS before letting a single probe through.
+USERSBOX_BREAKER_WINDOW = int(os.environ.get('USERSBOX_BREAKER_WINDOW', '20'))
+USERSBOX_BREAKER_MIN_CALLS = int(os.environ.get('USERSBOX_BREAKER_MIN_CALLS', '10'))
+USERSBOX_BREAKER_ERROR_RATE = float(os.environ.get('USERSBOX_BREAKER_ERROR_RATE', '0.5'))
+USERSBOX_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('USERSBOX_BREAKER_SLOW_CALL_SECONDS', '10'))
+USERSBOX_BREAKER_SLOW_CALL_RATE = float(os.environ.get('USERSBOX_BREAKER_SLOW_CALL_RATE', '0.5'))
+USERSBOX_BREAKER_OPEN_SECONDS = float(os.environ.get('USERSBOX_BREAKER_OPEN_SECONDS', '30'))
+# Hedged requests: a duplicate call is sent once the first one is slower than p95
+USERSBOX_HEDGE_ENABLED = os.environ.get('USERSBOX_HEDGE_ENABLED', 'false').lower() == 'true'
+USERSBOX_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('USERSBOX_HEDGE_MIN_DELAY_SECONDS', '1.0'))
+# Two-phase search: ask the cheap /explain endpoint for per-source counts
+# first and fetch hits only for the largest sources when anything was found
+USERSBOX_TWO_PHASE = os.environ.get('USERSBOX_TWO_PHASE', 'false').lower() == 'true'
+USERSBOX_TWO_PHASE_TOP_SOURCES = int(os.environ.get('USERSBOX_TWO_PHASE_TOP_SOURCES', '5'))
+# Progressive mode: chat searches go through /explain and the placeholder is
+# edited as each source's hits arrive, at most once per interval
+SEARCH_PROGRESSIVE = os.environ.get('SEARCH_PROGRESSIVE', 'false').lower() == 'true'
+SEARCH_PROGRESS_EDIT_INTERVAL_SECONDS = float(os.environ.get('SEARCH_PROGRESS_EDIT_INTERVAL_SECONDS', '1.5'))
+# Whether a search that found nothing still costs an attempt
+SEARCH_CHARGE_EMPTY_RESULTS = os.environ.get('SEARCH_CHARGE_EMPTY_RESULTS', 'true').lower() == 'true'
+# Lower value is served first
+SEARCH_PRIORITIES = {"interactive": 0, "admin": 1, "batch": 2, "background": 3}
+
+# Admission control Configuration
+# Each dependency gets a bulkhead: a concurrency cap plus a bounded wait queue
+# with a deadline, after which the work is shed instead of piling up.
+TELEGRAM_MAX_CONCURRENCY = int(os.environ.get('TELEGRAM_MAX_CONCURRENCY', '20'))
+TELEGRAM_MAX_QUEUE = int(os.environ.get('TELEGRAM_MAX_QUEUE', '500'))
+TELEGRAM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('TELEGRAM_QUEUE_TIMEOUT_SECONDS', '5'))
+MONGO_MAX_CONCURRENCY = int(os.environ.get('MONGO_MAX_CONCURRENCY', '50'))
+MONGO_MAX_QUEUE = int(os.environ.get('MONGO_MAX_QUEUE', '500'))
+MONGO_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('MONGO_QUEUE_TIMEOUT_SECONDS', '2'))
+# Chat searches not started within this time after submission are shed
+SEARCH_QUEUE_DEADLINE_SECONDS = float(os.environ.get('SEARCH_QUEUE_DEADLINE_SECONDS', '60'))
+# API search jobs can wait longer, but not forever
+SEARCH_API_QUEUE_DEADLINE_SECONDS = float(os.environ.get('SEARCH_API_QUEUE_DEADLINE_SECONDS', '600'))
+# New searches are refused while this many jobs are already queued
+SEARCH_QUEUE_MAX_DEPTH = int(os.environ.get('SEARCH_QUEUE_MAX_DEPTH', '500'))
+
+# Identifies this process when claiming leased work
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# Logging Configuration
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', '256'))
+LOG_MAX_MESSAGE_CHARS = int(os.environ.get('LOG_MAX_MESSAGE_CHARS', '2048'))
+# Comma separated "category=rate" pairs, e.g. "telegram.update=0.1,telegram.send=0.05"
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'telegram.update=0.1,telegram.send=0.1')
+
+# Logging pipeline
+# Records are pushed onto a bounded queue from the request path and formatted,
+# redacted and written by a background listener thread.
+LOG_STATS = {
+    "emitted": 0,
+    "dropped": 0,
+    "sampled_out": 0,
+    "emit_ns": 0,
+    "request_ns": 0,
+    "requests": 0
+}
+
+_SECRET_VALUES = [value for value in (TELEGRAM_TOKEN, WEBHOOK_SECRET, *USERSBOX_TOKENS) if value]
+_REDACT_PATTERNS = [
+    (re.compile(r'\b\d{6,12}:[A-Za-z0-9_-]{30,}\b'), '[token]'),  # Bot API tokens
+    (re.compile(r'eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+'), '[token]'),  # JWTs
+    (re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'), '[email]'),
+    (re.compile(r'\+\d[\d\s()-]{9,17}\d|(?<!\d)[78]\d{10}(?!\d)'), '[phone]'),
+]
+# Fields that carry user supplied content and are never written in clear text
+_REDACT_FIELDS = {'text', 'query', 'phone', 'email', 'first_name', 'last_name', 'username', 'secret', 'token'}
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """Parse "category=rate" pairs into a sampling table"""
+    rates = {}
+    for pair in spec.split(','):
+        if '=' not in pair:
+            continue
+        category, rate = pair.split('=', 1)
+        try:
+            rates[category.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+LOG_SAMPLE_TABLE = parse_sample_rates(LOG_SAMPLE_RATES)
+
+def redact_text(value: str) -> str:
+    """Mask secrets, tokens, emails and phone numbers and cap the length"""
+    for secret in _SECRET_VALUES:
+        value = value.replace(secret, '[secret]')
+    for pattern, replacement in _REDACT_PATTERNS:
+        value = pattern.sub(replacement, value)
+    if len(value) > LOG_MAX_FIELD_CHARS:
+        value = value[:LOG_MAX_FIELD_CHARS] + f"...(+{len(value) - LOG_MAX_FIELD_CHARS})"
+    return value
+
+def redact_value(key: str, value: Any) -> Any:
+    """Redact a structured log field"""
+    if key in _REDACT_FIELDS and value is not None:
+        return f"[redacted len={len(str(value))}]"
+    if isinstance(value, str):
+        return redact_text(value)
+    if isinstance(value, dict):
+        return {k: redact_value(k, v) for k, v in list(value.items())[:20]}
+    if isinstance(value, (list, tuple)):
+        return [redact_value(key, v) for v in value[:20]]
+    return value
+
+class JsonLogFormatter(logging.Formatter):
+    """Render log records as single line JSON documents"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "category": getattr(record, 'category', None),
+            "msg": redact_text(record.getMessage()[:LOG_MAX_MESSAGE_CHARS])
+        }
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            entry[key] = redact_value(key, value)
+        if record.exc_text:
+            entry["exc"] = redact_text(record.exc_text[-LOG_MAX_MESSAGE_CHARS:])
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge args here; JSON rendering and redaction run on the listener thread
+        record.msg = record.getMessage()[:LOG_MAX_MESSAGE_CHARS]
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_STATS["dropped"] += 1
+
+    def emit(self, record: logging.LogRecord):
+        started = time.perf_counter_ns()
+        super().emit(record)
+        LOG_STATS["emitted"] += 1
+        LOG_STATS["emit_ns"] += time.perf_counter_ns() - started
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Install the queue based JSON logging pipeline on the root logger"""
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter())
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(NonBlockingQueueHandler(log_queue))
+    root_logger.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
+
+def log_event(category: str, message: str, level: int = logging.INFO, **fields):
+    """Emit a structured, sampled log record for the given category"""
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING:
+        rate = LOG_SAMPLE_TABLE.get(category, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            LOG_STATS["sampled_out"] += 1
+            return
+    logger.log(level, message, extra={"category": category, "fields": fields})
+
+def get_logging_stats() -> Dict[str, Any]:
+    """Logging pipeline counters including overhead relative to request time"""
+    emitted = LOG_STATS["emitted"]
+    return {
+        **LOG_STATS,
+        "queue_depth": log_listener.queue.qsize(),
+        "avg_emit_us": (LOG_STATS["emit_ns"] / emitted / 1000) if emitted else 0,
+        "overhead_ratio": (LOG_STATS["emit_ns"] / LOG_STATS["request_ns"]) if LOG_STATS["request_ns"] else 0,
+        "sample_rates": LOG_SAMPLE_TABLE
+    }
+
+# Admission control
+class Overloaded(Exception):
+    """Raised when a dependency has no capacity within the allowed wait"""
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} is overloaded")
+        self.name = name
+
+class Bulkhead:
+    """Concurrency cap for one dependency with a bounded, deadline-limited wait queue"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters: deque = deque()
+        self.admitted = 0
+        self.shed = 0
+
+    async def acquire(self, timeout: Optional[float] = None):
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(self.name)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self._forget(future)
+            self.shed += 1
+            raise Overloaded(self.name)
+        except asyncio.CancelledError:
+            self._forget(future)
+            if future.done() and not future.cancelled():
+                # The slot was granted just before cancellation
+                self.release()
+            raise
+        self.admitted += 1
+
+    def _forget(self, future: asyncio.Future):
+        try:
+            self.waiters.remove(future)
+        except ValueError:
+            pass
+
+    def release(self):
+        self.active -= 1
+        while self.waiters and self.active < self.max_concurrency:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, timeout: Optional[float] = None):
+        await self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "saturation": (self.active + len(self.waiters)) / self.max_concurrency,
+            "admitted": self.admitted,
+            "shed": self.shed
+        }
+
+telegram_bulkhead = Bulkhead("telegram", TELEGRAM_MAX_CONCURRENCY, TELEGRAM_MAX_QUEUE, TELEGRAM_QUEUE_TIMEOUT_SECONDS)
+mongo_bulkhead = Bulkhead("mongo", MONGO_MAX_CONCURRENCY, MONGO_MAX_QUEUE, MONGO_QUEUE_TIMEOUT_SECONDS)
+
+USERSBOX_UNAVAILABLE_TEXT = (
+    "⚠️ Сервис поиска временно недоступен\n\n"
+    "Попытка не списана. Попробуйте через несколько минут."
+)
+
+BUSY_TEXT = (
+    "⏳ Сервис сейчас перегружен\n\n"
+    "Попытка не списана. Попробуйте через минуту."
+)
 
 # Create the main app
 app = FastAPI(title="Usersbox Telegram Bot API")
@@ -38,34 +464,57 @@ app = FastAPI(title="Usersbox Telegram Bot API")
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Models
-class User(BaseModel):
+# Records
+# The bot pipeline builds these straight from Mongo documents on every
+# update, so they are slotted dataclasses without validation. Request
+# bodies arriving over HTTP are still validated by pydantic models.
+class Record:
+    """Mongo document <-> slotted dataclass conversion without validation"""
+    __slots__ = ()
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]):
+        # __match_args__ lists the dataclass fields; _id and unknown keys are skipped
+        return cls(**{name: document[name] for name in cls.__match_args__ if name in document})
+
+    def to_document(self) -> Dict[str, Any]:
+        # Shallow on purpose: payloads such as search results are not copied
+        return {name: getattr(self, name) for name in self.__match_args__}
+
+@dataclass(slots=True)
+class User(Record):
     telegram_id: int
+    referral_code: str
     username: Optional[str] = None
     first_name: Optional[str] = None
     last_name: Optional[str] = None
     attempts_remaining: int = 0  # Changed to 0 by default
     referred_by: Optional[int] = None
-    referral_code: str
     total_referrals: int = 0
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = field(default_factory=datetime.utcnow)
     is_admin: bool = False
-    last_active: datetime = Field(default_factory=datetime.utcnow)
+    last_active: datetime = field(default_factory=datetime.utcnow)
     is_subscribed: bool = False
+    # Denormalized counters, maintained on search and referral inserts
+    total_searches: int = 0
+    successful_searches: int = 0
+    recent_searches: List[Dict[str, Any]] = field(default_factory=list)
 
-class Search(BaseModel):
+@dataclass(slots=True)
+class Search(Record):
     user_id: int
     query: str
     search_type: str  # phone, email, name, etc.
     results: Dict[str, Any]
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = field(default_factory=datetime.utcnow)
     attempt_used: bool = True
     success: bool = True
 
-class Referral(BaseModel):
+@dataclass(slots=True)
+class Referral(Record):
     referrer_id: int
     referred_id: int
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = field(default_factory=datetime.utcnow)
     attempt_given: bool = True
 
 class TelegramMessage(BaseModel):
@@ -241,8 +690,228 @@ def format_search_results(results: Dict[str, Any], query: str, search_type: str)
     
     return formatted_text
 
+# Shared state
+# Everything that must behave the same across uvicorn workers and pods (rate
+# limits, update dedup, caches, single-flight leases) goes through one small
+# key-value interface: Redis when REDIS_URL is set, process memory otherwise.
+STATE_STATS = {"errors": 0, "leases_acquired": 0, "lease_timeouts": 0}
+
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+_REDIS_INCR = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if value == tonumber(ARGV[1]) and tonumber(ARGV[2]) > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+_REDIS_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class StateBackend(ABC):
+    """Key-value operations the bot needs to share state between replicas"""
+
+    kind: str
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def set_if_absent(self, key: str, value: str, ttl: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Atomically add to a counter; the TTL applies when the counter is created"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def release(self, key: str, token: str):
+        """Delete the key only if it still holds our token"""
+
+    @abstractmethod
+    async def take_token(self, key: str, rate: float, burst: float) -> bool:
+        """Take one token from a bucket refilled at rate per second up to burst"""
+
+    @asynccontextmanager
+    async def lease(self, key: str, ttl: float = STATE_LEASE_SECONDS, wait: float = STATE_LEASE_WAIT_SECONDS):
+        """Short exclusive lease; yields False if it could not be taken within the wait"""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        acquired = False
+        try:
+            acquired = await self.set_if_absent(key, token, ttl)
+            while not acquired and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                acquired = await self.set_if_absent(key, token, ttl)
+        except Exception as e:
+            STATE_STATS["errors"] += 1
+            logging.error(f"State lease error: {e}")
+        STATE_STATS["leases_acquired" if acquired else "lease_timeouts"] += 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    await self.release(key, token)
+                except Exception as e:
+                    STATE_STATS["errors"] += 1
+                    logging.error(f"State lease release error: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"kind": self.kind}
+
+class MemoryStateBackend(StateBackend):
+    """Process-local backend; correct for a single worker only"""
+
+    kind = "memory"
+
+    def __init__(self, max_keys: int = STATE_MEMORY_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> (value, expires_at or None)
+        self.values: Dict[str, tuple] = {}
+
+    def _live(self, key: str, now: float) -> Optional[tuple]:
+        item = self.values.get(key)
+        if item is not None and item[1] is not None and item[1] <= now:
+            del self.values[key]
+            return None
+        return item
+
+    def _store(self, key: str, value: Any, ttl: Optional[float], now: float):
+        if key not in self.values and len(self.values) >= self.max_keys:
+            self._prune(now)
+        self.values[key] = (value, now + ttl if ttl else None)
+
+    def _prune(self, now: float):
+        for key, (_, expires_at) in list(self.values.items()):
+            if expires_at is not None and expires_at <= now:
+                del self.values[key]
+        # Still full: drop the oldest half, dicts keep insertion order
+        if len(self.values) >= self.max_keys:
+            for key in list(self.values)[:len(self.values) // 2]:
+                del self.values[key]
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._live(key, time.monotonic())
+        return item[0] if item is not None else None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._store(key, value, ttl, time.monotonic())
+
+    async def set_if_absent(self, key: str, value: str, ttl: float) -> bool:
+        now = time.monotonic()
+        if self._live(key, now) is not None:
+            return False
+        self._store(key, value, ttl, now)
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.monotonic()
+        item = self._live(key, now)
+        if item is None:
+            self._store(key, amount, ttl, now)
+            return amount
+        value = int(item[0]) + amount
+        self.values[key] = (value, item[1])
+        return value
+
+    async def delete(self, key: str):
+        self.values.pop(key, None)
+
+    async def release(self, key: str, token: str):
+        item = self._live(key, time.monotonic())
+        if item is not None and item[0] == token:
+            del self.values[key]
+
+    async def take_token(self, key: str, rate: float, burst: float) -> bool:
+        now = time.monotonic()
+        item = self._live(key, now)
+        tokens, ts = item[0] if item is not None else (burst, now)
+        tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # A bucket that has refilled completely carries no state worth keeping
+        self._store(key, (tokens, now), burst / rate + 1, now)
+        return allowed
+
+    def stats(self) -> Dict[str, Any]:
+        return {"kind": self.kind, "keys": len(self.values), "max_keys": self.max_keys}
+
+class RedisStateBackend(StateBackend):
+    """Backend for any server speaking the Redis protocol"""
+
+    kind = "redis"
+
+    def __init__(self, client):
+        self.redis = client
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.redis.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.redis.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def set_if_absent(self, key: str, value: str, ttl: float) -> bool:
+        return bool(await self.redis.set(key, value, px=int(ttl * 1000), nx=True))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return int(await self.redis.eval(_REDIS_INCR, 1, key, amount, int(ttl * 1000) if ttl else 0))
+
+    async def delete(self, key: str):
+        await self.redis.delete(key)
+
+    async def release(self, key: str, token: str):
+        await self.redis.eval(_REDIS_RELEASE, 1, key, token)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> bool:
+        return bool(await self.redis.eval(_REDIS_TOKEN_BUCKET, 1, key, rate, burst, time.time()))
+
+state_backend: StateBackend = (
+    RedisStateBackend(aioredis.from_url(REDIS_URL, decode_responses=True))
+    if aioredis is not None and REDIS_URL else MemoryStateBackend()
+)
+
 async def check_subscription(user_id: int) -> bool:
     """Check if user is subscribed to required channel"""
+    cache_key = f"subscribed:{user_id}"
+    try:
+        if await state_backend.get(cache_key) is not None:
+            return True
+    except Exception as e:
+        STATE_STATS["errors"] += 1
+        logging.error(f"Subscription cache error: {e}")
+
     try:
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChatMember"
         params = {
@@ -250,21 +919,33 @@ async def check_subscription(user_id: int) -> bool:
             "user_id": user_id
         }
         
-        response = requests.get(url, params=params, timeout=10)
+        response = await asyncio.to_thread(requests.get, url, params=params, timeout=10)
         if response.status_code == 200:
             data = response.json()
             if data.get('ok'):
                 status = data.get('result', {}).get('status')
-                return status in ['member', 'administrator', 'creator']
+                subscribed = status in ['member', 'administrator', 'creator']
+                # Only positive answers are cached so a fresh subscription is seen at once
+                if subscribed:
+                    try:
+                        await state_backend.set(cache_key, "1", SUBSCRIPTION_CACHE_TTL_SECONDS)
+                    except Exception as e:
+                        STATE_STATS["errors"] += 1
+                        logging.error(f"Subscription cache error: {e}")
+                return subscribed
         
         return False
     except Exception as e:
         logging.error(f"Subscription check error: {e}")
         return False
 
-async def send_telegram_message(chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None) -> bool:
-    """Send message to Telegram user with optional keyboard"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+async def call_telegram_api(method: str, payload: Dict[str, Any], timeout: float = 10) -> requests.Response:
+    """Call a Bot API method without blocking the event loop"""
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/{method}"
+    async with telegram_bulkhead.slot():
+        return await asyncio.to_thread(requests.post, url, json=payload, timeout=timeout)
+
+def build_message_payload(chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None) -> Dict[str, Any]:
     payload = {
         "chat_id": chat_id,
         "text": text
@@ -276,15 +957,46 @@ async def send_telegram_message(chat_id: int, text: str, parse_mode: str = None,
     
     if reply_markup:
         payload["reply_markup"] = reply_markup
+    return payload
+
+async def post_telegram_message(chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None) -> Optional[int]:
+    """Send message to Telegram user and return its message_id"""
+    payload = build_message_payload(chat_id, text, parse_mode, reply_markup)
     
     try:
-        logging.info(f"Sending message to chat_id={chat_id}, text length={len(text)}")
-        response = requests.post(url, json=payload, timeout=10)
-        logging.info(f"Telegram API response: status={response.status_code}, response={response.text}")
-        return response.status_code == 200
+        response = await call_telegram_api("sendMessage", payload)
+        if response.status_code == 200:
+            log_event("telegram.send", "Message sent", chat_id=chat_id, text_length=len(text))
+            return response.json().get('result', {}).get('message_id')
+        log_event(
+            "telegram.send", "Telegram API rejected message", logging.WARNING,
+            chat_id=chat_id, status=response.status_code, response=response.text[:LOG_MAX_FIELD_CHARS]
+        )
+        return None
     except Exception as e:
         logging.error(f"Failed to send Telegram message: {e}")
-        return False
+        return None
+
+async def send_telegram_message(chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None) -> bool:
+    """Send message to Telegram user with optional keyboard"""
+    return await post_telegram_message(chat_id, text, parse_mode, reply_markup) is not None
+
+async def edit_telegram_message(chat_id: int, message_id: Optional[int], text: str, parse_mode: str = None) -> bool:
+    """Replace the text of a sent message, falling back to a new message if the edit fails"""
+    if message_id is not None:
+        payload = build_message_payload(chat_id, text, parse_mode)
+        payload["message_id"] = message_id
+        try:
+            response = await call_telegram_api("editMessageText", payload)
+            if response.status_code == 200:
+                return True
+            log_event(
+                "telegram.send", "Message edit rejected", logging.WARNING,
+                chat_id=chat_id, status=response.status_code, response=response.text[:LOG_MAX_FIELD_CHARS]
+            )
+        except Exception as e:
+            logging.error(f"Failed to edit Telegram message: {e}")
+    return await send_telegram_message(chat_id, text, parse_mode)
 
 async def get_or_create_user(telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> User:
     """Get existing user or create new one"""
@@ -303,7 +1015,7 @@ async def get_or_create_user(telegram_id: int, username: str = None, first_name:
                 }
             }
         )
-        return User(**user_data)
+        return User.from_document(user_data)
     else:
         # Create new user
         referral_code = generate_referral_code(telegram_id)
@@ -319,64 +1031,2468 @@ async def get_or_create_user(telegram_id: int, username: str = None, first_name:
             attempts_remaining=999 if is_admin else 0  # Admin gets unlimited, others get 0
         )
         
-        await db.users.insert_one(user.dict())
+        document = user.to_document()
+        await db.users.insert_one(document)
+        run_in_background(record_analytics(user.created_at, {"new_users": 1}))
+        dashboard_events.emit("users", document)
         return user
 
-async def process_referral(referred_user_id: int, referral_code: str) -> bool:
-    """Process referral and give attempt to referrer"""
-    try:
-        # Find referrer by code
-        referrer = await db.users.find_one({"referral_code": referral_code})
-        if not referrer or referrer['telegram_id'] == referred_user_id:
-            return False
+_background_tasks: set = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    """Schedule a coroutine without awaiting it, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Dashboard events
+# One producer, the in-process bus or a Mongo change stream when available,
+# feeds every connected dashboard. Each event is serialized once and handed
+# to per-connection queues, so the cost does not grow with open dashboards.
+def dashboard_event(collection: str, document: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Map an inserted document to the event pushed to dashboards"""
+    if collection == "users":
+        return {
+            "type": "user",
+            "delta": {"total_users": 1},
+            "user": {key: document.get(key) for key in ("telegram_id", "username", "created_at")}
+        }
+    if collection == "searches":
+        return {
+            "type": "search",
+            "delta": {"total_searches": 1, "successful_searches": 1 if document.get("success") else 0},
+            "search": {key: document.get(key) for key in ("user_id", "query", "search_type", "success", "timestamp")}
+        }
+    if collection == "referrals":
+        return {
+            "type": "referral",
+            "delta": {"total_referrals": 1},
+            "referral": {key: document.get(key) for key in ("referrer_id", "referred_id", "timestamp")}
+        }
+    if collection == "attempt_grants":
+        return {
+            "type": "grant",
+            "grant": {
+                "grant_id": document.get("_id"),
+                "attempts": document.get("attempts"),
+                "granted": document.get("granted"),
+                "finished_at": document.get("finished_at")
+            }
+        }
+    return None
+
+# Cached dashboard responses each event type makes stale
+DASHBOARD_CACHE_INVALIDATION = {
+    "user": ("stats", "users"),
+    "search": ("stats", "searches", "users"),
+    "referral": ("stats", "users"),
+    "grant": ("users",)
+}
+
+class ResponseCache:
+    """Serialized dashboard responses with ETags, shared through the state backend"""
+
+    def __init__(self, ttl: float, backend: StateBackend):
+        self.ttl = ttl
+        self.backend = backend
+        # Local generations catch writes seen by this worker before the shared bump lands
+        self.generations: Dict[str, int] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            self.generations[key] = self.generations.get(key, 0) + 1
+        run_in_background(self._invalidate_shared(keys))
+
+    async def _invalidate_shared(self, keys: tuple):
+        try:
+            for key in keys:
+                await self.backend.incr(f"dashboard-gen:{key}")
+                await self.backend.delete(f"dashboard:{key}")
+        except Exception as e:
+            STATE_STATS["errors"] += 1
+            logging.error(f"Dashboard cache invalidation error: {e}")
+
+    async def _load(self, key: str) -> Optional[tuple]:
+        try:
+            value = await self.backend.get(f"dashboard:{key}")
+        except Exception as e:
+            STATE_STATS["errors"] += 1
+            logging.error(f"Dashboard cache read error: {e}")
+            return None
+        if value is None:
+            return None
+        etag, body = value.split("\n", 1)
+        return body, etag
+
+    async def _generation(self, key: str) -> tuple:
+        try:
+            shared = await self.backend.get(f"dashboard-gen:{key}")
+        except Exception:
+            shared = None
+        return self.generations.get(key, 0), shared
+
+    async def _entry(self, key: str, build: Callable[[], Awaitable[Any]]) -> tuple:
+        entry = await self._load(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        # One rebuild per key across all workers; the others wait and read its result
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            async with self.backend.lease(f"lease:dashboard:{key}"):
+                entry = await self._load(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+                generation = await self._generation(key)
+                body = json.dumps(jsonable_encoder(await build()))
+                entry = (body, f'"{hashlib.sha1(body.encode()).hexdigest()}"')
+                # A write during the rebuild makes this body stale already
+                if await self._generation(key) == generation:
+                    try:
+                        await self.backend.set(f"dashboard:{key}", f"{entry[1]}\n{body}", self.ttl)
+                    except Exception as e:
+                        STATE_STATS["errors"] += 1
+                        logging.error(f"Dashboard cache write error: {e}")
+                return entry
+
+    async def respond(self, request: Request, key: str, build: Callable[[], Awaitable[Any]]) -> Response:
+        body, etag = await self._entry(key, build)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified}
+
+dashboard_cache = ResponseCache(DASHBOARD_CACHE_TTL_SECONDS, state_backend)
+
+class DashboardSubscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=DASHBOARD_SUBSCRIBER_QUEUE_SIZE)
+        # Set when events had to be dropped; the client must refetch a snapshot
+        self.lagging = False
+
+class DashboardStream:
+    """Fan-out of dashboard events to connected SSE clients"""
+
+    def __init__(self):
+        self.subscribers: set = set()
+        self.replay: deque = deque(maxlen=DASHBOARD_SUBSCRIBER_QUEUE_SIZE)
+        self.next_id = 1
+        # Ids are only ordered within one process, so they carry a per-process tag
+        self.tag = uuid.uuid4().hex[:8]
+        self.mode = "local"
+        self.resume_token = None
+        self.published = 0
+        self.dropped = 0
+
+    def emit(self, collection: str, document: Dict[str, Any]):
+        """Called at write sites; ignored while a change stream is the producer"""
+        if self.mode == "local":
+            self.publish(collection, document)
+
+    def publish(self, collection: str, document: Dict[str, Any]):
+        event = dashboard_event(collection, document)
+        if event is None:
+            return
+        dashboard_cache.invalidate(*DASHBOARD_CACHE_INVALIDATION.get(event["type"], ()))
+        event_id = self.next_id
+        self.next_id += 1
+        message = f"id: {self.tag}-{event_id}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+        self.replay.append((event_id, message))
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                subscriber.lagging = True
+                self.subscribers.discard(subscriber)
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> DashboardSubscriber:
+        subscriber = DashboardSubscriber()
+        if last_event_id:
+            tag, _, last = last_event_id.rpartition("-")
+            if tag != self.tag or not last.isdigit():
+                # Issued by another replica or before a restart; nothing here to resume from
+                subscriber.lagging = True
+                return subscriber
+            last = int(last)
+            if self.replay and self.replay[0][0] > last + 1:
+                # Missed more than the replay buffer holds
+                subscriber.lagging = True
+                return subscriber
+            for event_id, message in self.replay:
+                if event_id > last:
+                    subscriber.queue.put_nowait(message)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def last_id(self) -> str:
+        """Id of the newest event, for a client that has just resynced"""
+        return f"{self.tag}-{self.next_id - 1}"
+
+    def unsubscribe(self, subscriber: DashboardSubscriber):
+        self.subscribers.discard(subscriber)
+
+    async def watch_changes(self):
+        """Publish inserts seen by a Mongo change stream, falling back to the local bus"""
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "insert", "ns.coll": {"$in": ["users", "searches", "referrals"]}},
+            {"operationType": "update", "ns.coll": "attempt_grants",
+             "updateDescription.updatedFields.status": "done"}
+        ]}}]
+        while True:
+            try:
+                async with db.watch(pipeline, full_document="updateLookup", resume_after=self.resume_token) as stream:
+                    self.mode = "change_stream"
+                    log_event("dashboard", "Dashboard events from change stream")
+                    async for change in stream:
+                        self.resume_token = stream.resume_token
+                        self.publish(change["ns"]["coll"], change.get("fullDocument") or {})
+            except OperationFailure as e:
+                self.mode = "local"
+                if DASHBOARD_EVENT_SOURCE == "auto":
+                    # Standalone servers have no change streams
+                    log_event("dashboard", "Change streams unavailable, using local events", error=str(e))
+                    return
+                logging.error(f"Dashboard change stream error: {e}")
+                self.resume_token = None
+            except Exception as e:
+                self.mode = "local"
+                logging.error(f"Dashboard change stream error: {e}")
+            await asyncio.sleep(5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+dashboard_events = DashboardStream()
+
+# Analytics rollups
+# Hourly, daily and all-time bucket documents in analytics_buckets are
+# incremented on every write so dashboards never scan the raw collections.
+ANALYTICS_FIELDS = ("new_users", "searches", "searches_success", "referrals")
+ANALYTICS_BREAKDOWNS = ("searches_by_type", "searches_success_by_type")
+
+def floor_hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def floor_day(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def analytics_bucket_id(granularity: str, start: Optional[datetime]) -> str:
+    if granularity == "hour":
+        return f"hour:{start:%Y-%m-%dT%H}"
+    if granularity == "day":
+        return f"day:{start:%Y-%m-%d}"
+    return "total"
+
+def search_analytics_increments(search_type: str, success: bool) -> Dict[str, int]:
+    increments = {"searches": 1, f"searches_by_type.{search_type}": 1}
+    if success:
+        increments["searches_success"] = 1
+        increments[f"searches_success_by_type.{search_type}"] = 1
+    return increments
+
+async def record_analytics(ts: datetime, increments: Dict[str, int]):
+    """Increment the hourly, daily and all-time buckets containing ts"""
+    buckets = [("hour", floor_hour(ts)), ("day", floor_day(ts)), ("total", None)]
+    try:
+        await db.analytics_buckets.bulk_write([
+            UpdateOne(
+                {"_id": analytics_bucket_id(granularity, start)},
+                {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+                upsert=True
+            )
+            for granularity, start in buckets
+        ], ordered=False)
+    except Exception as e:
+        logging.error(f"Analytics rollup error: {e}")
+
+def empty_analytics() -> Dict[str, Any]:
+    return {**{name: 0 for name in ANALYTICS_FIELDS}, **{name: {} for name in ANALYTICS_BREAKDOWNS}}
+
+def merge_analytics(total: Dict[str, Any], bucket: Dict[str, Any]):
+    for name in ANALYTICS_FIELDS:
+        total[name] += bucket.get(name, 0)
+    for name in ANALYTICS_BREAKDOWNS:
+        for key, count in (bucket.get(name) or {}).items():
+            total[name][key] = total[name].get(key, 0) + count
+
+async def get_analytics_window(start: datetime, end: Optional[datetime] = None) -> Dict[str, Any]:
+    """Sum rollup buckets over [start, end) at hourly resolution.
+
+    Whole days inside the window are read from daily buckets and only the
+    partial days at either edge from hourly ones.
+    """
+    now = datetime.utcnow()
+    end = end or now
+    if end >= now:
+        # Nothing is recorded after now, so the current day counts as whole
+        end = floor_day(now) + timedelta(days=1)
+    start = floor_hour(start)
+    first_day = start if start == floor_day(start) else floor_day(start) + timedelta(days=1)
+    last_day = floor_day(end)
+
+    if first_day < last_day:
+        ranges = [
+            {"granularity": "day", "start": {"$gte": first_day, "$lt": last_day}},
+            {"granularity": "hour", "start": {"$gte": start, "$lt": first_day}},
+            {"granularity": "hour", "start": {"$gte": last_day, "$lt": end}}
+        ]
+    else:
+        ranges = [{"granularity": "hour", "start": {"$gte": start, "$lt": end}}]
+
+    total = empty_analytics()
+    async for bucket in analytics_db.analytics_buckets.find({"$or": ranges}):
+        merge_analytics(total, bucket)
+    return total
+
+async def get_analytics_totals() -> Dict[str, Any]:
+    """All-time rollup counters"""
+    total = empty_analytics()
+    merge_analytics(total, await analytics_db.analytics_buckets.find_one({"_id": "total"}) or {})
+    return total
+
+async def get_dashboard_totals() -> Dict[str, int]:
+    """All-time totals from collection counts; unlike the rollups they need no backfill"""
+    searches, archived = analytics_db.searches, analytics_db.searches_archive
+    return {
+        "total_users": await analytics_db.users.estimated_document_count(),
+        "total_searches": await searches.estimated_document_count() + await archived.estimated_document_count(),
+        "total_referrals": await analytics_db.referrals.estimated_document_count(),
+        # Served from the success index
+        "successful_searches": (
+            await searches.count_documents({"success": True}) + await archived.count_documents({"success": True})
+        )
+    }
+
+async def get_analytics_series(granularity: str, start: datetime, end: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Bucket documents of one granularity for charting"""
+    query = {"granularity": granularity, "start": {"$gte": start, "$lt": end or datetime.utcnow() + timedelta(days=1)}}
+    series = await analytics_db.analytics_buckets.find(query).sort("start", 1).to_list(None)
+    for bucket in series:
+        bucket.pop("granularity", None)
+        bucket["_id"] = str(bucket["_id"])
+    return series
+
+async def rebuild_analytics_buckets() -> Dict[str, int]:
+    """Recompute all rollup buckets from the raw collections.
+
+    Buckets are built in a side collection and renamed over the live one.
+    Raw rows are scanned up to the start of the rebuild; for the current
+    hour each counter keeps the larger of the raw count and the live one.
+    Live increments recorded while the side collection is written are
+    replayed into it just before the rename, so only increments landing
+    between that replay and the rename are lost.
+    """
+    hourly: Dict[datetime, Dict[str, Any]] = {}
+    started = datetime.utcnow()
+    cutoff = floor_hour(started)
+
+    async def collect(collection, time_field: str, group: Dict[str, Any], to_increments):
+        pipeline = [
+            {"$match": {time_field: {"$type": "date", "$lt": started}}},
+            {"$group": {
+                "_id": {"hour": {"$dateToString": {"format": "%Y-%m-%dT%H", "date": f"${time_field}"}}, **group},
+                "count": {"$sum": 1}
+            }}
+        ]
+        async for row in collection.aggregate(pipeline, allowDiskUse=True):
+            hour = datetime.strptime(row["_id"]["hour"], "%Y-%m-%dT%H")
+            bucket = hourly.setdefault(hour, empty_analytics())
+            for key, count in to_increments(row["_id"]).items():
+                if '.' in key:
+                    name, sub_key = key.split('.', 1)
+                    bucket[name][sub_key] = bucket[name].get(sub_key, 0) + count * row["count"]
+                else:
+                    bucket[key] += count * row["count"]
+
+    async def live_hours() -> Dict[datetime, Dict[str, Any]]:
+        live = {}
+        async for bucket in db.analytics_buckets.find({"granularity": "hour", "start": {"$gte": cutoff}}):
+            live[bucket["start"]] = empty_analytics()
+            merge_analytics(live[bucket["start"]], bucket)
+        return live
+
+    await collect(db.users, "created_at", {}, lambda _: {"new_users": 1})
+    await collect(db.referrals, "timestamp", {}, lambda _: {"referrals": 1})
+    # Archived searches keep search_type, success and timestamp, enough for the rollups
+    for searches in (db.searches, db.searches_archive):
+        await collect(
+            searches, "timestamp", {"search_type": "$search_type", "success": "$success"},
+            lambda key: search_analytics_increments(key.get("search_type") or "general", bool(key.get("success")))
+        )
+
+    # Both sides count the same events; the raw scan misses rows written after it
+    # started and the live buckets miss rows written before rollups were enabled
+    snapshot = await live_hours()
+    for hour, counts in snapshot.items():
+        bucket = hourly.setdefault(hour, empty_analytics())
+        for name in ANALYTICS_FIELDS:
+            bucket[name] = max(bucket[name], counts[name])
+        for name in ANALYTICS_BREAKDOWNS:
+            for key, count in counts[name].items():
+                bucket[name][key] = max(bucket[name].get(key, 0), count)
+
+    documents: Dict[str, Dict[str, Any]] = {}
+    for hour, counts in hourly.items():
+        for granularity, start in [("hour", hour), ("day", floor_day(hour)), ("total", None)]:
+            bucket_id = analytics_bucket_id(granularity, start)
+            document = documents.setdefault(
+                bucket_id, {"_id": bucket_id, "granularity": granularity, "start": start, **empty_analytics()}
+            )
+            merge_analytics(document, counts)
+
+    if not documents:
+        await db.analytics_buckets.delete_many({})
+        return {"buckets": 0}
+    # A name per run so concurrent rebuilds never write into each other's collection
+    staging = db[f"analytics_buckets_rebuild_{uuid.uuid4().hex[:12]}"]
+    try:
+        await staging.create_index([("granularity", 1), ("start", 1)])
+        await staging.insert_many(list(documents.values()), ordered=False)
+
+        replay = []
+        for hour, counts in (await live_hours()).items():
+            before = snapshot.get(hour) or empty_analytics()
+            increments = {name: counts[name] - before[name] for name in ANALYTICS_FIELDS}
+            for name in ANALYTICS_BREAKDOWNS:
+                for key, count in counts[name].items():
+                    increments[f"{name}.{key}"] = count - before[name].get(key, 0)
+            increments = {key: value for key, value in increments.items() if value > 0}
+            if not increments:
+                continue
+            for granularity, start in [("hour", hour), ("day", floor_day(hour)), ("total", None)]:
+                replay.append(UpdateOne(
+                    {"_id": analytics_bucket_id(granularity, start)},
+                    {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+                    upsert=True
+                ))
+        if replay:
+            await staging.bulk_write(replay, ordered=False)
+        await staging.rename("analytics_buckets", dropTarget=True)
+    except Exception:
+        await staging.drop()
+        raise
+    return {"buckets": len(documents)}
+
+async def backfill_analytics_buckets():
+    """Build the rollups once for data written before they existed"""
+    async with state_backend.lease("lease:analytics-rebuild", ttl=3600, wait=0) as acquired:
+        if not acquired or await db.analytics_buckets.find_one({"_id": "total"}, {"_id": 1}) is not None:
+            return
+        try:
+            result = await rebuild_analytics_buckets()
+            log_event("analytics", "Analytics rollups backfilled", buckets=result["buckets"])
+        except Exception as e:
+            logging.error(f"Analytics backfill error: {e}")
+
+async def process_referral(referred_user_id: int, referral_code: str) -> bool:
+    """Process referral and give attempt to referrer"""
+    try:
+        # Find referrer by code
+        referrer = await db.users.find_one(
+            {"referral_code": referral_code},
+            {"telegram_id": 1, "total_referrals": 1}
+        )
+        if not referrer or referrer['telegram_id'] == referred_user_id:
+            return False
+
+        referral = Referral(
+            referrer_id=referrer['telegram_id'],
+            referred_id=referred_user_id
+        )
+        balance_updates = [
+            # Give attempt to referrer and update referral count
+            UpdateOne(
+                {"telegram_id": referrer['telegram_id']},
+                {"$inc": {"attempts_remaining": 1, "total_referrals": 1}}
+            ),
+            # Give 1 attempt to referred user
+            UpdateOne(
+                {"telegram_id": referred_user_id},
+                {"$set": {"referred_by": referrer['telegram_id']}, "$inc": {"attempts_remaining": 1}}
+            )
+        ]
+
+        # The unique (referrer_id, referred_id) index rejects duplicate taps of the same link
+        try:
+            if MONGO_USE_TRANSACTIONS:
+                async with await client.start_session() as session:
+                    async with session.start_transaction():
+                        await db.referrals.insert_one(referral.to_document(), session=session)
+                        await db.users.bulk_write(balance_updates, ordered=False, session=session)
+            else:
+                await db.referrals.insert_one(referral.to_document())
+                await db.users.bulk_write(balance_updates, ordered=False)
+        except DuplicateKeyError:
+            return False
+        run_in_background(record_analytics(referral.timestamp, {"referrals": 1}))
+        dashboard_events.emit("referrals", referral.to_document())
+
+        # Notify referrer through the outbox without holding up the /start reply
+        await queue_telegram_message(
+            referrer['telegram_id'],
+            f"🎉 *Поздравляем!* Пользователь присоединился по вашей реферальной ссылке!\n\n"
+            f"💎 Вы получили +1 попытку поиска\n"
+            f"👥 Всего рефералов: {referrer.get('total_referrals', 0) + 1}"
+        )
+
+        return True
+    except Exception as e:
+        logging.error(f"Referral processing error: {e}")
+        return False
+
+async def record_search(search: Search, search_id: Optional[str] = None):
+    """Store a search and update the user's counters in a single user update.
+
+    With search_id the search is recorded at most once, so a retried job
+    cannot count twice. Attempts are reserved when the job is submitted.
+    """
+    document = search.to_document()
+    if search_id is not None:
+        document["_id"] = search_id
+    try:
+        await db.searches.insert_one(document)
+    except DuplicateKeyError:
+        return
+    run_in_background(record_analytics(
+        search.timestamp, search_analytics_increments(search.search_type, search.success)
+    ))
+    dashboard_events.emit("searches", document)
+
+    increments = {"total_searches": 1}
+    if search.success:
+        increments["successful_searches"] = 1
+
+    summary = {
+        "query": search.query[:50],
+        "search_type": search.search_type,
+        "success": search.success,
+        "timestamp": search.timestamp
+    }
+    await db.users.update_one(
+        {"telegram_id": search.user_id},
+        {
+            "$inc": increments,
+            "$push": {"recent_searches": {"$each": [summary], "$slice": -RECENT_SEARCHES_KEPT}}
+        }
+    )
+
+async def backfill_user_counters(batch_size: int = 500) -> Dict[str, int]:
+    """Rebuild per-user counters from the searches, searches_archive and referrals collections.
+
+    Counters are overwritten with $set, so run this before traffic starts or
+    accept that searches made during the backfill may be counted twice.
+    Needs MongoDB 5.2+ for $topN.
+    """
+    updated = 0
+    pending = []
+
+    async def flush():
+        nonlocal updated, pending
+        if pending:
+            result = await db.users.bulk_write(pending, ordered=False)
+            updated += result.modified_count
+            pending = []
+
+    search_totals = db.searches.aggregate([
+        {"$unionWith": "searches_archive"},
+        {"$group": {
+            "_id": "$user_id",
+            "total": {"$sum": 1},
+            "successful": {"$sum": {"$cond": ["$success", 1, 0]}},
+            # Bounded per user, unlike pushing every search and slicing afterwards
+            "recent": {"$topN": {
+                "n": RECENT_SEARCHES_KEPT,
+                "sortBy": {"timestamp": -1},
+                "output": {
+                    "query": {"$substrCP": ["$query", 0, 50]},
+                    "search_type": "$search_type",
+                    "success": "$success",
+                    "timestamp": "$timestamp"
+                }
+            }}
+        }}
+    ], allowDiskUse=True)
+    async for row in search_totals:
+        pending.append(UpdateOne(
+            {"telegram_id": row["_id"]},
+            {"$set": {
+                "total_searches": row["total"],
+                "successful_searches": row["successful"],
+                # Stored oldest first, like the live $push with $slice
+                "recent_searches": row["recent"][::-1]
+            }}
+        ))
+        if len(pending) >= batch_size:
+            await flush()
+
+    referral_totals = db.referrals.aggregate([
+        {"$group": {"_id": "$referrer_id", "count": {"$sum": 1}}}
+    ])
+    async for row in referral_totals:
+        pending.append(UpdateOne(
+            {"telegram_id": row["_id"]},
+            {"$set": {"total_referrals": row["count"]}}
+        ))
+        if len(pending) >= batch_size:
+            await flush()
+
+    await flush()
+    return {"users_updated": updated}
+
+# Search retention
+# Old searches lose their raw payload first and are later moved into a
+# slim archive collection. Work is done in small batches with pauses in
+# between so the job never competes with live traffic.
+RETENTION_STATS = {"payloads_purged": 0, "searches_archived": 0, "last_run": None, "last_error": None}
+
+async def purge_search_payloads(cutoff: datetime, max_batches: Optional[int] = None) -> int:
+    """Drop raw results from searches older than cutoff, keeping the result count"""
+    purged = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = await db.searches.find(
+            {"timestamp": {"$lt": cutoff}, "results": {"$exists": True}},
+            {"_id": 1}
+        ).limit(RETENTION_BATCH_SIZE).to_list(RETENTION_BATCH_SIZE)
+        if not batch:
+            break
+
+        result = await db.searches.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in batch]}},
+            [
+                {"$set": {"result_count": {"$ifNull": ["$results.data.count", 0]}, "payload_purged": True}},
+                {"$unset": "results"}
+            ]
+        )
+        purged += result.modified_count
+        RETENTION_STATS["payloads_purged"] += result.modified_count
+        batches += 1
+        await asyncio.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return purged
+
+async def archive_searches(cutoff: datetime, max_batches: Optional[int] = None) -> int:
+    """Move searches older than cutoff into searches_archive with minimal fields"""
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = await db.searches.find(
+            {"timestamp": {"$lt": cutoff}},
+            {"user_id": 1, "query": 1, "search_type": 1, "success": 1, "timestamp": 1,
+             "result_count": 1, "results.data.count": 1}
+        ).limit(RETENTION_BATCH_SIZE).to_list(RETENTION_BATCH_SIZE)
+        if not batch:
+            break
+
+        documents = []
+        for doc in batch:
+            results = doc.pop("results", None) or {}
+            doc.setdefault("result_count", (results.get("data") or {}).get("count", 0))
+            documents.append(doc)
+
+        # Archive documents keep the original _id, so a rerun after a crash is harmless
+        try:
+            await db.searches_archive.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+        result = await db.searches.delete_many({"_id": {"$in": [doc["_id"] for doc in documents]}})
+        archived += result.deleted_count
+        RETENTION_STATS["searches_archived"] += result.deleted_count
+        batches += 1
+        await asyncio.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return archived
+
+async def run_retention_pass(max_batches: Optional[int] = None) -> Dict[str, int]:
+    """Run one incremental retention pass over the searches collection.
+
+    Every replica runs the loop, so a pass only starts under the retention
+    lease and is skipped while another process holds it.
+    """
+    async with state_backend.lease("lease:retention", ttl=RETENTION_INTERVAL_SECONDS, wait=0) as acquired:
+        if not acquired:
+            return {"archived": 0, "payloads_purged": 0, "skipped": True}
+        now = datetime.utcnow()
+        try:
+            archived = await archive_searches(now - timedelta(days=SEARCH_ARCHIVE_AFTER_DAYS), max_batches)
+            purged = await purge_search_payloads(now - timedelta(days=SEARCH_PAYLOAD_RETENTION_DAYS), max_batches)
+            RETENTION_STATS["last_error"] = None
+            return {"archived": archived, "payloads_purged": purged}
+        except Exception as e:
+            RETENTION_STATS["last_error"] = str(e)
+            raise
+        finally:
+            RETENTION_STATS["last_run"] = now
+
+async def retention_loop():
+    while True:
+        try:
+            await run_retention_pass()
+        except Exception as e:
+            logging.error(f"Search retention error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+# Telegram outbox
+# Messages that must survive a restart (paid search results, notifications)
+# are written to the outbox collection and delivered by a dispatcher that
+# claims batches under a lease, so several replicas can share the work.
+OUTBOX_STATS = {"enqueued": 0, "delivered": 0, "retried": 0, "deferred": 0, "failed": 0, "latency_ms_total": 0.0}
+_outbox_wakeup = asyncio.Event()
+
+async def queue_telegram_message(
+    chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None,
+    edit_message_id: Optional[int] = None, outbox_id: Optional[str] = None
+) -> str:
+    """Durably queue a message for delivery and return its outbox id.
+
+    With edit_message_id the message replaces the text of an already sent
+    message and is posted as a new one if the edit is rejected. A caller
+    supplied outbox_id makes queueing idempotent.
+    """
+    entry = outbox_entry(chat_id, text, parse_mode, reply_markup, edit_message_id, outbox_id)
+    try:
+        await db.outbox.insert_one(entry)
+    except DuplicateKeyError:
+        return entry["_id"]
+    OUTBOX_STATS["enqueued"] += 1
+    _outbox_wakeup.set()
+    return entry["_id"]
+
+def outbox_entry(
+    chat_id: int, text: str, parse_mode: str = None, reply_markup: dict = None,
+    edit_message_id: Optional[int] = None, outbox_id: Optional[str] = None,
+    not_before: Optional[datetime] = None
+) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    entry = {
+        "_id": outbox_id or str(uuid.uuid4()),
+        "chat_id": chat_id,
+        "method": "sendMessage",
+        "payload": build_message_payload(chat_id, text, parse_mode, reply_markup),
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": max(now, not_before) if not_before else now
+    }
+    if edit_message_id is not None:
+        entry["method"] = "editMessageText"
+        entry["payload"]["message_id"] = edit_message_id
+        entry["fallback_method"] = "sendMessage"
+    return entry
+
+async def queue_telegram_messages(entries: List[Dict[str, Any]]) -> int:
+    """Queue many outbox entries at once, skipping ids that are already queued"""
+    if not entries:
+        return 0
+    try:
+        result = await db.outbox.insert_many(entries, ordered=False)
+        inserted = len(result.inserted_ids)
+    except BulkWriteError as e:
+        inserted = e.details.get("nInserted", 0)
+    OUTBOX_STATS["enqueued"] += inserted
+    _outbox_wakeup.set()
+    return inserted
+
+async def claim_outbox_batch() -> List[Dict[str, Any]]:
+    """Lease a batch of due messages to this instance"""
+    now = datetime.utcnow()
+    claimable = {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": now}},
+        {"status": "sending", "lease_expires_at": {"$lt": now}}
+    ]}
+    candidates = await db.outbox.find(claimable, {"_id": 1}).sort("created_at", 1) \
+        .limit(OUTBOX_BATCH_SIZE).to_list(OUTBOX_BATCH_SIZE)
+    if not candidates:
+        return []
+
+    # Re-applying the filter in the update makes the claim safe against other replicas
+    claim_id = str(uuid.uuid4())
+    await db.outbox.update_many(
+        {"_id": {"$in": [doc["_id"] for doc in candidates]}, **claimable},
+        {"$set": {
+            "status": "sending",
+            "claim_id": claim_id,
+            "lease_owner": INSTANCE_ID,
+            "lease_expires_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        }}
+    )
+    return await db.outbox.find({"claim_id": claim_id}).sort("created_at", 1).to_list(OUTBOX_BATCH_SIZE)
+
+def outbox_retry_delay(attempts: int) -> float:
+    delay = min(OUTBOX_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), OUTBOX_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+async def deliver_outbox_message(message: Dict[str, Any]):
+    """Deliver one leased message and record the outcome"""
+    attempts = message.get("attempts", 0) + 1
+    retry_after = None
+    permanent = False
+    try:
+        response = await call_telegram_api(message["method"], message["payload"])
+        if response.status_code == 400 and message.get("fallback_method"):
+            # The message to edit is gone or unchanged; post a new one instead
+            payload = {key: value for key, value in message["payload"].items() if key != "message_id"}
+            message["method"], message["payload"] = message["fallback_method"], payload
+            await db.outbox.update_one(
+                {"_id": message["_id"]},
+                {"$set": {"method": message["method"], "payload": payload}, "$unset": {"fallback_method": ""}}
+            )
+            response = await call_telegram_api(message["method"], payload)
+        if response.status_code == 200:
+            now = datetime.utcnow()
+            await db.outbox.update_one(
+                {"_id": message["_id"]},
+                {"$set": {"status": "done", "attempts": attempts, "completed_at": now},
+                 "$unset": {"claim_id": "", "lease_owner": "", "lease_expires_at": ""}}
+            )
+            OUTBOX_STATS["delivered"] += 1
+            OUTBOX_STATS["latency_ms_total"] += (now - message["created_at"]).total_seconds() * 1000
+            return
+        error = response.text[:500]
+        if response.status_code == 429:
+            retry_after = (response.json().get("parameters") or {}).get("retry_after")
+        # Blocked bots, deleted chats and malformed messages will never succeed
+        permanent = response.status_code in (400, 403)
+    except Overloaded as e:
+        # Shed locally before Telegram was called, so this was not a delivery attempt
+        OUTBOX_STATS["deferred"] += 1
+        await db.outbox.update_one(
+            {"_id": message["_id"]},
+            {"$set": {
+                "status": "pending",
+                "next_attempt_at": datetime.utcnow() + timedelta(seconds=outbox_retry_delay(1))
+            }, "$unset": {"claim_id": "", "lease_owner": "", "lease_expires_at": ""}}
+        )
+        log_event("outbox", "Outbox message deferred", logging.WARNING, chat_id=message["chat_id"], dependency=e.name)
+        return
+    except Exception as e:
+        error = str(e)
+
+    if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+        update = {"status": "failed", "attempts": attempts, "last_error": error, "completed_at": datetime.utcnow()}
+        OUTBOX_STATS["failed"] += 1
+        log_event("outbox", "Outbox message failed", logging.WARNING, chat_id=message["chat_id"], error=error)
+    else:
+        delay = retry_after or outbox_retry_delay(attempts)
+        update = {
+            "status": "pending",
+            "attempts": attempts,
+            "last_error": error,
+            "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)
+        }
+        OUTBOX_STATS["retried"] += 1
+    await db.outbox.update_one(
+        {"_id": message["_id"]},
+        {"$set": update, "$unset": {"claim_id": "", "lease_owner": "", "lease_expires_at": ""}}
+    )
+
+async def deliver_chat_messages(messages: List[Dict[str, Any]]):
+    # Messages for one chat go out in order; different chats are delivered concurrently
+    for message in messages:
+        await deliver_outbox_message(message)
+
+async def outbox_dispatcher():
+    """Deliver queued messages, waking immediately when new ones are queued locally"""
+    while True:
+        # Clear before claiming so messages queued during delivery are not missed
+        _outbox_wakeup.clear()
+        try:
+            batch = await claim_outbox_batch()
+            if batch:
+                by_chat: Dict[int, List[Dict[str, Any]]] = {}
+                for message in batch:
+                    by_chat.setdefault(message["chat_id"], []).append(message)
+                await asyncio.gather(*(deliver_chat_messages(messages) for messages in by_chat.values()))
+                if len(batch) == OUTBOX_BATCH_SIZE:
+                    continue
+        except Exception as e:
+            logging.error(f"Outbox dispatcher error: {e}")
+
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+def get_outbox_stats() -> Dict[str, Any]:
+    delivered = OUTBOX_STATS["delivered"]
+    return {
+        **OUTBOX_STATS,
+        "avg_latency_ms": OUTBOX_STATS["latency_ms_total"] / delivered if delivered else 0
+    }
+
+# Bulk attempt grants
+# A grant is identified by a client-supplied id. Every credit is a document in
+# attempt_grant_credits, unique per (grant_id, telegram_id), so re-running a
+# grant after a crash or a retried request never credits anyone twice.
+GRANT_NOTIFICATION_TEXT = (
+    "🎁 *Вам выданы попытки!*\n\n"
+    "💎 Получено попыток: {attempts}\n"
+    "Можете продолжать поиск!"
+)
+
+def grant_criteria_query(criteria: Dict[str, Any]) -> Dict[str, Any]:
+    query = {}
+    if criteria.get("active_days") is not None:
+        query["last_active"] = {"$gte": datetime.utcnow() - timedelta(days=criteria["active_days"])}
+    if criteria.get("min_referrals") is not None:
+        query["total_referrals"] = {"$gte": criteria["min_referrals"]}
+    return query
+
+async def iter_grant_targets(grant: Dict[str, Any]) -> AsyncIterator[List[int]]:
+    """Chunks of telegram ids targeted by a grant"""
+    if grant.get("user_ids") is not None:
+        user_ids = grant["user_ids"]
+        for start in range(0, len(user_ids), BULK_GRANT_CHUNK_SIZE):
+            yield user_ids[start:start + BULK_GRANT_CHUNK_SIZE]
+        return
+
+    chunk = []
+    cursor = db.users.find(grant_criteria_query(grant["criteria"]), {"telegram_id": 1}).batch_size(BULK_GRANT_CHUNK_SIZE)
+    async for user in cursor:
+        chunk.append(user["telegram_id"])
+        if len(chunk) >= BULK_GRANT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def create_attempt_grant(
+    grant_id: str, attempts: int, source: str,
+    user_ids: Optional[List[int]] = None, criteria: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Record a grant, or return the existing one with the same id"""
+    grant = {
+        "_id": grant_id,
+        "attempts": attempts,
+        "source": source,
+        "user_ids": list(dict.fromkeys(user_ids)) if user_ids is not None else None,
+        "criteria": criteria,
+        "status": "running",
+        "batches": 0,
+        "granted": 0,
+        "created_at": datetime.utcnow()
+    }
+    try:
+        await db.attempt_grants.insert_one(grant)
+        return grant
+    except DuplicateKeyError:
+        existing = await db.attempt_grants.find_one({"_id": grant_id})
+        if existing["attempts"] != attempts or existing.get("user_ids") != grant["user_ids"] \
+                or existing.get("criteria") != criteria:
+            raise ValueError(f"Grant {grant_id} already exists with different parameters")
+        return existing
+
+async def apply_grant_batch(grant: Dict[str, Any], batch_no: int, user_ids: List[int], notify_offset: int) -> int:
+    """Credit one chunk of users, audit it and schedule their notifications"""
+    grant_id, attempts = grant["_id"], grant["attempts"]
+    existing = [user["telegram_id"] async for user in db.users.find(
+        {"telegram_id": {"$in": user_ids}}, {"telegram_id": 1}
+    )]
+    if existing:
+        # The unique index lets only one run claim each credit
+        now = datetime.utcnow()
+        try:
+            await db.attempt_grant_credits.insert_many([
+                {"grant_id": grant_id, "telegram_id": user_id, "attempts": attempts, "applied": False, "created_at": now}
+                for user_id in existing
+            ], ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    # Claimed but unapplied credits, including ones left by an interrupted run.
+    # pending_grants marks users whose $inc landed before the credit was marked applied.
+    to_apply = [credit["telegram_id"] async for credit in db.attempt_grant_credits.find(
+        {"grant_id": grant_id, "telegram_id": {"$in": user_ids}, "applied": False}, {"telegram_id": 1}
+    )]
+    credited = 0
+    if to_apply:
+        result = await db.users.bulk_write([
+            UpdateOne(
+                {"telegram_id": user_id, "pending_grants": {"$ne": grant_id}},
+                {"$inc": {"attempts_remaining": attempts}, "$addToSet": {"pending_grants": grant_id}}
+            )
+            for user_id in to_apply
+        ], ordered=False)
+        credited = result.modified_count
+        await db.attempt_grant_credits.update_many(
+            {"grant_id": grant_id, "telegram_id": {"$in": to_apply}}, {"$set": {"applied": True}}
+        )
+
+    # Includes users credited by an earlier, interrupted run of this grant
+    granted = [credit["telegram_id"] async for credit in db.attempt_grant_credits.find(
+        {"grant_id": grant_id, "telegram_id": {"$in": user_ids}, "applied": True}, {"telegram_id": 1}
+    )]
+    if granted:
+        await db.users.update_many(
+            {"telegram_id": {"$in": granted}, "pending_grants": grant_id}, {"$pull": {"pending_grants": grant_id}}
+        )
+
+    await db.attempt_grant_batches.update_one(
+        {"_id": f"{grant_id}:{batch_no}"},
+        {"$set": {
+            "grant_id": grant_id,
+            "batch": batch_no,
+            "attempts": attempts,
+            "requested": len(user_ids),
+            "credited": credited,
+            "granted": len(granted),
+            "created_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+    now = datetime.utcnow()
+    text = GRANT_NOTIFICATION_TEXT.format(attempts=attempts)
+    await queue_telegram_messages([
+        outbox_entry(
+            user_id, text, outbox_id=f"grant:{grant_id}:{user_id}",
+            not_before=now + timedelta(seconds=(notify_offset + index) / BULK_GRANT_NOTIFY_RATE)
+        )
+        for index, user_id in enumerate(granted)
+    ])
+    return len(granted)
+
+class GrantLeaseLost(Exception):
+    """Another runner took over the grant"""
+
+async def claim_attempt_grant(grant_id: str, owner: str) -> bool:
+    """Take the grant's lease unless a live runner holds it"""
+    now = datetime.utcnow()
+    claimed = await db.attempt_grants.find_one_and_update(
+        {"_id": grant_id, "status": {"$ne": "done"}, "$or": [
+            {"lease_expires_at": {"$exists": False}},
+            {"lease_expires_at": {"$lt": now}}
+        ]},
+        {"$set": {
+            "status": "running",
+            "lease_owner": owner,
+            "lease_expires_at": now + timedelta(seconds=BULK_GRANT_LEASE_SECONDS)
+        }}
+    )
+    return claimed is not None
+
+async def run_attempt_grant(grant: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a grant in chunks; safe to call again for a grant that was interrupted.
+
+    A second call while the grant is being applied returns the grant as it
+    stands instead of starting another runner.
+    """
+    if grant["status"] == "done":
+        return grant
+    # The instance id alone is not enough: one process can receive the same grant twice
+    owner = f"{INSTANCE_ID}:{uuid.uuid4().hex[:8]}"
+    if not await claim_attempt_grant(grant["_id"], owner):
+        log_event("grants", "Attempt grant already running", grant_id=grant["_id"])
+        return await db.attempt_grants.find_one({"_id": grant["_id"]}) or grant
+
+    batch_no = granted = 0
+    try:
+        async for user_ids in iter_grant_targets(grant):
+            batch_no += 1
+            # Renew before each batch and stop if the lease has passed to another runner
+            renewed = await db.attempt_grants.update_one(
+                {"_id": grant["_id"], "lease_owner": owner},
+                {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=BULK_GRANT_LEASE_SECONDS)}}
+            )
+            if renewed.matched_count == 0:
+                raise GrantLeaseLost(grant["_id"])
+            granted += await apply_grant_batch(grant, batch_no, user_ids, granted)
+            await db.attempt_grants.update_one(
+                {"_id": grant["_id"], "lease_owner": owner}, {"$set": {"batches": batch_no, "granted": granted}}
+            )
+    except GrantLeaseLost:
+        log_event("grants", "Attempt grant lease lost", logging.WARNING, grant_id=grant["_id"], batches=batch_no)
+        return await db.attempt_grants.find_one({"_id": grant["_id"]}) or grant
+    except Exception as e:
+        logging.error(f"Attempt grant {grant['_id']} failed: {e}")
+        await db.attempt_grants.update_one(
+            {"_id": grant["_id"], "lease_owner": owner},
+            {"$set": {"status": "failed", "error": str(e)}, "$unset": {"lease_owner": "", "lease_expires_at": ""}}
+        )
+        raise
+    grant.update(status="done", batches=batch_no, granted=granted, finished_at=datetime.utcnow())
+    await db.attempt_grants.update_one(
+        {"_id": grant["_id"], "lease_owner": owner},
+        {"$set": {"status": "done", "batches": batch_no, "granted": granted, "finished_at": grant["finished_at"]},
+         "$unset": {"error": "", "lease_owner": "", "lease_expires_at": ""}}
+    )
+    log_event("grants", "Attempt grant applied", grant_id=grant["_id"], granted=granted, batches=batch_no)
+    dashboard_events.emit("attempt_grants", grant)
+    return grant
+
+def serialize_attempt_grant(grant: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "grant_id": grant["_id"],
+        "status": grant["status"],
+        "attempts": grant["attempts"],
+        "source": grant.get("source"),
+        "criteria": grant.get("criteria"),
+        "user_count": len(grant["user_ids"]) if grant.get("user_ids") is not None else None,
+        "batches": grant.get("batches", 0),
+        "granted": grant.get("granted", 0),
+        "error": grant.get("error"),
+        "created_at": grant.get("created_at"),
+        "finished_at": grant.get("finished_at")
+    }
+
+def remaining_attempts_footer(attempts_remaining: int) -> str:
+    """Footer appended to search results for users with limited attempts"""
+    if attempts_remaining > 0:
+        return f"💎 Осталось попыток: {attempts_remaining}"
+    return (
+        "❌ Попытки закончились!\n\n"
+        "🔗 Получите больше попыток, пригласив друзей:\n"
+        "Используйте /referral"
+    )
+
+class UsersboxScheduler:
+    """Global concurrency cap for Usersbox calls with priority classes and
+    round-robin between users inside a class."""
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        # priority -> user key -> waiting futures, in round-robin order
+        self.queues: Dict[int, 'OrderedDict[Any, deque]'] = {
+            priority: OrderedDict() for priority in SEARCH_PRIORITIES.values()
+        }
+        self.wait_samples: Dict[int, deque] = {
+            priority: deque(maxlen=500) for priority in SEARCH_PRIORITIES.values()
+        }
+        self.granted = 0
+        self.shed = 0
+
+    def queued(self) -> int:
+        return sum(len(waiters) for users in self.queues.values() for waiters in users.values())
+
+    async def acquire(self, key: Any, priority: int, timeout: Optional[float] = None):
+        started = time.monotonic()
+        if self.active < self.max_concurrency and self.queued() == 0:
+            self.active += 1
+        else:
+            if self.queued() >= self.max_queue:
+                self.shed += 1
+                raise Overloaded("usersbox")
+            future = asyncio.get_running_loop().create_future()
+            self.queues[priority].setdefault(key, deque()).append(future)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._forget(key, priority, future)
+                self.shed += 1
+                raise Overloaded("usersbox")
+            except asyncio.CancelledError:
+                self._forget(key, priority, future)
+                if future.done() and not future.cancelled():
+                    # The slot was granted just before cancellation
+                    self.release()
+                raise
+        self.granted += 1
+        self.wait_samples[priority].append(time.monotonic() - started)
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free and nobody is waiting for it"""
+        if self.active < self.max_concurrency and self.queued() == 0:
+            self.active += 1
+            self.granted += 1
+            return True
+        return False
+
+    def _forget(self, key: Any, priority: int, future: asyncio.Future):
+        waiters = self.queues[priority].get(key)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.queues[priority][key]
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.max_concurrency:
+            future = self._next_waiter()
+            if future is None:
+                break
+            self.active += 1
+            future.set_result(None)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self.queues):
+            users = self.queues[priority]
+            while users:
+                key = next(iter(users))
+                waiters = users[key]
+                future = waiters.popleft()
+                if waiters:
+                    users.move_to_end(key)
+                else:
+                    del users[key]
+                if not future.done():
+                    return future
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        names = {value: name for name, value in SEARCH_PRIORITIES.items()}
+        classes = {}
+        for priority, users in self.queues.items():
+            samples = sorted(self.wait_samples[priority])
+            classes[names[priority]] = {
+                "queued": sum(len(waiters) for waiters in users.values()),
+                "queued_users": len(users),
+                "wait_ms_avg": (sum(samples) / len(samples) * 1000) if samples else 0,
+                "wait_ms_p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000 if samples else 0,
+                "wait_ms_max": samples[-1] * 1000 if samples else 0
+            }
+        queued = self.queued()
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queued": queued,
+            "saturation": (self.active + queued) / self.max_concurrency,
+            "granted": self.granted,
+            "shed": self.shed,
+            "classes": classes
+        }
+
+usersbox_scheduler = UsersboxScheduler(USERSBOX_MAX_CONCURRENCY, USERSBOX_MAX_QUEUE)
+
+class CircuitOpenError(Exception):
+    """Raised without calling the upstream while its circuit breaker is open"""
+
+class CircuitBreaker:
+    """Error-rate and latency circuit breaker with half-open probing"""
+
+    def __init__(
+        self, name: str, window: int, min_calls: int, error_rate: float,
+        slow_call_seconds: float, slow_call_rate: float, open_seconds: float
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        # (failed, slow) for the most recent calls
+        self.outcomes: deque = deque(maxlen=window)
+        self.latencies: deque = deque(maxlen=500)
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+        self.rejected = 0
+
+    def available(self) -> bool:
+        """Whether a call could go through now, without reserving a probe"""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        return not (self.state == "half_open" and self.probe_in_flight)
+
+    def before_call(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = "half_open"
+        if self.state == "open" or (self.state == "half_open" and self.probe_in_flight):
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        if self.state == "half_open":
+            self.probe_in_flight = True
+
+    def abandon(self):
+        """Forget a call that never reached the upstream"""
+        if self.state == "half_open":
+            self.probe_in_flight = False
+
+    def record(self, failed: bool, latency: float):
+        slow = latency >= self.slow_call_seconds
+        if not failed:
+            self.latencies.append(latency)
+        if self.state == "half_open":
+            self.probe_in_flight = False
+            if failed or slow:
+                self._trip()
+            else:
+                self.state = "closed"
+                self.outcomes.clear()
+                log_event("usersbox", "Circuit closed", breaker=self.name)
+            return
+
+        self.outcomes.append((failed, slow))
+        if len(self.outcomes) >= self.min_calls:
+            failures = sum(1 for failed, _ in self.outcomes if failed)
+            slow_calls = sum(1 for _, slow in self.outcomes if slow)
+            if (failures / len(self.outcomes) >= self.error_rate
+                    or slow_calls / len(self.outcomes) >= self.slow_call_rate):
+                self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self.outcomes.clear()
+        log_event("usersbox", "Circuit opened", logging.WARNING, breaker=self.name)
+
+    def latency_p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        samples = sorted(self.latencies)
+        return samples[int(len(samples) * 0.95)]
+
+    def stats(self) -> Dict[str, Any]:
+        calls = len(self.outcomes)
+        p95 = self.latency_p95()
+        return {
+            "state": self.state,
+            "calls_in_window": calls,
+            "error_rate": sum(1 for failed, _ in self.outcomes if failed) / calls if calls else 0,
+            "slow_call_rate": sum(1 for _, slow in self.outcomes if slow) / calls if calls else 0,
+            "latency_ms_p95": p95 * 1000 if p95 is not None else None,
+            "retry_in_seconds": max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+            if self.state == "open" else 0,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+usersbox_breaker = CircuitBreaker(
+    "usersbox", USERSBOX_BREAKER_WINDOW, USERSBOX_BREAKER_MIN_CALLS, USERSBOX_BREAKER_ERROR_RATE,
+    USERSBOX_BREAKER_SLOW_CALL_SECONDS, USERSBOX_BREAKER_SLOW_CALL_RATE, USERSBOX_BREAKER_OPEN_SECONDS
+)
+USERSBOX_STATS = {"calls": 0, "hedged": 0, "hedge_wins": 0, "explain_short_circuits": 0, "truncated": 0}
+
+@dataclass
+class UsersboxKey:
+    name: str
+    token: str = field(repr=False)
+    in_flight: int = 0
+    calls: int = 0
+    errors: int = 0
+    throttled: int = 0
+    balance: Optional[float] = None
+    cooldown_until: float = 0.0
+    # Name of the key's rate bucket in the state backend, the same on every replica
+    state_key: str = ""
+
+class UsersboxKeyPool:
+    """Spreads Usersbox calls over several keys, each with its own rate limit,
+    and rests keys that are throttled or out of balance. Rate buckets and
+    cool-downs live in the state backend so replicas share each key's quota."""
+
+    def __init__(self, tokens: List[str], strategy: str, rate: float, burst: float, backend: StateBackend):
+        self.keys = [
+            UsersboxKey(
+                name=f"key{index}", token=token,
+                state_key=f"usersbox-key:{hashlib.sha1(token.encode()).hexdigest()[:12]}"
+            )
+            for index, token in enumerate(tokens, 1)
+        ]
+        self.strategy = strategy
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend
+        # Used only while the shared backend is unreachable
+        self.local = MemoryStateBackend()
+        self.next_index = 0
+
+    def _candidates(self, now: float) -> List[UsersboxKey]:
+        ready = [key for key in self.keys if key.cooldown_until <= now]
+        if self.strategy == "round_robin":
+            return sorted(ready, key=lambda key: (self.keys.index(key) - self.next_index) % len(self.keys))
+        return sorted(ready, key=lambda key: key.in_flight)
+
+    async def _take(self, key: UsersboxKey) -> bool:
+        try:
+            # Another replica may have been told to back off this key
+            if await self.backend.get(f"{key.state_key}:cooldown") is not None:
+                return False
+            return await self.backend.take_token(key.state_key, self.rate, self.burst)
+        except Exception as e:
+            STATE_STATS["errors"] += 1
+            logging.error(f"Usersbox key state error: {e}")
+        return await self.local.take_token(key.state_key, self.rate, self.burst)
+
+    async def acquire(self) -> UsersboxKey:
+        deadline = time.monotonic() + USERSBOX_KEY_MAX_WAIT_SECONDS
+        while True:
+            now = time.monotonic()
+            for key in self._candidates(now):
+                if await self._take(key):
+                    self.next_index = (self.keys.index(key) + 1) % len(self.keys)
+                    key.in_flight += 1
+                    key.calls += 1
+                    return key
+            # A token refills within 1/rate seconds; rested keys return when their cool-down ends
+            wait = min([1 / self.rate] + [key.cooldown_until - now for key in self.keys if key.cooldown_until > now])
+            if now + wait > deadline:
+                raise Overloaded("usersbox keys")
+            await asyncio.sleep(wait)
+
+    def release(self, key: UsersboxKey, response: Optional['UsersboxResponse']):
+        key.in_flight -= 1
+        if response is None:
+            key.errors += 1
+            return
+        if response.status_code == 429:
+            key.throttled += 1
+            retry_after = response.headers.get('Retry-After')
+            try:
+                cooldown = float(retry_after) if retry_after else USERSBOX_KEY_COOLDOWN_SECONDS
+            except ValueError:
+                cooldown = USERSBOX_KEY_COOLDOWN_SECONDS
+            self.cool_down(key, cooldown)
+        elif response.status_code in (401, 402, 403):
+            # Revoked key or no balance left; rest it until the next balance check
+            key.errors += 1
+            self.cool_down(key, max(USERSBOX_BALANCE_REFRESH_SECONDS, USERSBOX_KEY_COOLDOWN_SECONDS))
+        elif response.status_code >= 500:
+            key.errors += 1
+
+    def cool_down(self, key: UsersboxKey, seconds: float):
+        key.cooldown_until = max(key.cooldown_until, time.monotonic() + seconds)
+        run_in_background(self._share_cool_down(key, seconds))
+        log_event("usersbox", "Key cooling down", logging.WARNING, key=key.name, seconds=seconds)
+
+    async def _share_cool_down(self, key: UsersboxKey, seconds: float):
+        try:
+            await self.backend.set(f"{key.state_key}:cooldown", "1", seconds)
+        except Exception as e:
+            STATE_STATS["errors"] += 1
+            logging.error(f"Usersbox key state error: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "strategy": self.strategy,
+            "keys": {
+                key.name: {
+                    "in_flight": key.in_flight,
+                    "calls": key.calls,
+                    "errors": key.errors,
+                    "throttled": key.throttled,
+                    "balance": key.balance,
+                    "cooldown_seconds": max(0.0, key.cooldown_until - now)
+                }
+                for key in self.keys
+            }
+        }
+
+usersbox_keys = UsersboxKeyPool(
+    USERSBOX_TOKENS, USERSBOX_KEY_STRATEGY, USERSBOX_KEY_RATE_PER_SECOND, USERSBOX_KEY_BURST, state_backend
+)
+
+async def refresh_usersbox_balances():
+    """Read each key's balance and rest keys that have run out"""
+    for key in usersbox_keys.keys:
+        try:
+            response = await asyncio.to_thread(
+                requests.get, f"{USERSBOX_BASE_URL}/getMe",
+                headers={"Authorization": key.token}, timeout=USERSBOX_TIMEOUT_SECONDS
+            )
+            if response.status_code != 200:
+                continue
+            key.balance = (response.json().get('data') or {}).get('balance')
+            if key.balance is not None and key.balance <= 0:
+                usersbox_keys.cool_down(key, USERSBOX_BALANCE_REFRESH_SECONDS)
+        except Exception as e:
+            logging.error(f"Usersbox balance check failed for {key.name}: {e}")
+
+async def usersbox_balance_loop():
+    while True:
+        await refresh_usersbox_balances()
+        await asyncio.sleep(USERSBOX_BALANCE_REFRESH_SECONDS)
+
+@dataclass
+class UsersboxResponse:
+    """Decoded Usersbox reply with long hit lists cut while reading"""
+    status_code: int
+    headers: Any
+    payload: Any = None
+    text: str = ""
+    truncated: bool = False
+
+    def json(self) -> Any:
+        if self.payload is None:
+            raise ValueError(f"Usersbox returned a non-JSON response: {self.text[:200]}")
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"Usersbox returned {self.status_code}: {self.text[:200]}")
+
+def usersbox_array_caps(path: str) -> Dict[str, int]:
+    """Element limits for the arrays of a response, by ijson prefix"""
+    if path in ("/search", "/explain"):
+        return {"data.items": USERSBOX_MAX_SOURCES, "data.items.item.hits.items": USERSBOX_ITEMS_PER_SOURCE}
+    # Per-source search puts the hits directly under data
+    return {"data.items": USERSBOX_ITEMS_PER_SOURCE, "data.hits.items": USERSBOX_ITEMS_PER_SOURCE}
+
+class LimitedReader:
+    """File-like wrapper that refuses to read past a byte limit"""
+
+    def __init__(self, raw, limit: int):
+        self.raw = raw
+        self.remaining = limit
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.raw.read(size)
+        self.remaining -= len(chunk)
+        if self.remaining < 0:
+            raise ValueError("Usersbox response is too large")
+        return chunk
+
+def decode_json_stream(stream, array_caps: Dict[str, int]) -> tuple:
+    """Build a document from ijson events, dropping array elements past the caps.
+
+    Returns (document, truncated). Dropped elements are skipped event by
+    event and never materialized.
+    """
+    root = None
+    # (container, key for the next map value, element cap for arrays)
+    stack: List[list] = []
+    skip_depth = 0
+    truncated = False
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if skip_depth:
+            if event in ('start_map', 'start_array'):
+                skip_depth += 1
+            elif event in ('end_map', 'end_array'):
+                skip_depth -= 1
+            continue
+        if event == 'map_key':
+            stack[-1][1] = value
+            continue
+        if event in ('end_map', 'end_array'):
+            stack.pop()
+            continue
+
+        if stack:
+            parent, key, cap = stack[-1]
+            if isinstance(parent, list) and cap is not None and len(parent) >= cap:
+                truncated = True
+                if event in ('start_map', 'start_array'):
+                    skip_depth = 1
+                continue
+
+        node = {} if event == 'start_map' else [] if event == 'start_array' else value
+        if not stack:
+            root = node
+        elif isinstance(stack[-1][0], list):
+            stack[-1][0].append(node)
+        else:
+            stack[-1][0][stack[-1][1]] = node
+        if event in ('start_map', 'start_array'):
+            stack.append([node, None, array_caps.get(prefix)])
+    return root, truncated
+
+def trim_json_arrays(value: Any, array_caps: Dict[str, int], prefix: str = "") -> tuple:
+    """Apply the same caps to an already decoded document"""
+    truncated = False
+    if isinstance(value, dict):
+        for key in value:
+            value[key], cut = trim_json_arrays(value[key], array_caps, f"{prefix}.{key}" if prefix else key)
+            truncated = truncated or cut
+    elif isinstance(value, list):
+        cap = array_caps.get(prefix)
+        if cap is not None and len(value) > cap:
+            del value[cap:]
+            truncated = True
+        item_prefix = f"{prefix}.item" if prefix else "item"
+        for index, item in enumerate(value):
+            value[index], cut = trim_json_arrays(item, array_caps, item_prefix)
+            truncated = truncated or cut
+    return value, truncated
+
+def fetch_usersbox(url: str, token: str, query: str, array_caps: Dict[str, int]) -> UsersboxResponse:
+    """Blocking Usersbox request that decodes the body incrementally"""
+    with requests.get(
+        url, headers={"Authorization": token}, params={"q": query},
+        timeout=USERSBOX_TIMEOUT_SECONDS, stream=True
+    ) as response:
+        if response.status_code == 200 and ijson is not None:
+            response.raw.decode_content = True
+            payload, truncated = decode_json_stream(
+                LimitedReader(response.raw, USERSBOX_MAX_RESPONSE_BYTES), array_caps
+            )
+            return UsersboxResponse(response.status_code, response.headers, payload, truncated=truncated)
+
+        # Error bodies are small; without ijson the whole body is decoded first
+        body = response.raw.read(USERSBOX_MAX_RESPONSE_BYTES + 1, decode_content=True)
+        if len(body) > USERSBOX_MAX_RESPONSE_BYTES:
+            raise ValueError("Usersbox response is too large")
+        text = body.decode(response.encoding or 'utf-8', errors='replace')
+        try:
+            payload, truncated = trim_json_arrays(json.loads(text), array_caps)
+        except ValueError:
+            payload, truncated = None, False
+        return UsersboxResponse(response.status_code, response.headers, payload, text[:LOG_MAX_FIELD_CHARS], truncated)
+
+async def usersbox_get(
+    query: str, path: str = "/search", on_finish: Optional[Callable[[], None]] = None
+) -> UsersboxResponse:
+    """Make one Usersbox request with a pooled key.
+
+    A cancelled caller does not stop the request thread, so the key (and
+    on_finish) is released only once the request itself has ended.
+    """
+    try:
+        key = await usersbox_keys.acquire()
+    except BaseException:
+        if on_finish is not None:
+            on_finish()
+        raise
+    USERSBOX_STATS["calls"] += 1
+    call = asyncio.ensure_future(asyncio.to_thread(
+        fetch_usersbox, f"{USERSBOX_BASE_URL}{path}", key.token, query, usersbox_array_caps(path)
+    ))
+
+    def finished(task: asyncio.Future):
+        failed = task.cancelled() or task.exception() is not None
+        usersbox_keys.release(key, None if failed else task.result())
+        if on_finish is not None:
+            on_finish()
+
+    call.add_done_callback(finished)
+    response = await asyncio.shield(call)
+    if response.truncated:
+        USERSBOX_STATS["truncated"] += 1
+    return response
+
+async def hedged_usersbox_get(query: str, path: str = "/search") -> UsersboxResponse:
+    """Send a duplicate call once the first one is slower than p95 and take the first success"""
+    running = 1
+    hedge_slot = False
+
+    def call_finished():
+        # The hedge's scheduler slot is held until both requests have ended
+        nonlocal running
+        running -= 1
+        if running == 0 and hedge_slot:
+            usersbox_scheduler.release()
+
+    primary = asyncio.ensure_future(usersbox_get(query, path, on_finish=call_finished))
+    p95 = usersbox_breaker.latency_p95()
+    if not USERSBOX_HEDGE_ENABLED or p95 is None:
+        return await primary
+
+    done, _ = await asyncio.wait({primary}, timeout=max(p95, USERSBOX_HEDGE_MIN_DELAY_SECONDS))
+    # Hedging only uses a free scheduler slot, so the concurrency cap still holds
+    if done or running == 0 or not usersbox_scheduler.try_acquire():
+        return await primary
+
+    hedge_slot = True
+    running += 1
+    USERSBOX_STATS["hedged"] += 1
+    hedge = asyncio.ensure_future(usersbox_get(query, path, on_finish=call_finished))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        USERSBOX_STATS["hedge_wins"] += 1
+                    return task.result()
+        return primary.result()
+    finally:
+        # The losing request finishes in its thread; its result is discarded
+        for task in pending:
+            task.cancel()
+
+async def usersbox_search(
+    query: str, user_key: Any = None, priority: str = "background", wait_timeout: Optional[float] = None,
+    path: str = "/search"
+) -> UsersboxResponse:
+    """Call a Usersbox search endpoint through the circuit breaker and fair scheduler.
+
+    Raises CircuitOpenError while Usersbox is failing and Overloaded if no
+    slot frees up within wait_timeout seconds.
+    """
+    if not usersbox_breaker.available():
+        usersbox_breaker.rejected += 1
+        raise CircuitOpenError("usersbox circuit is open")
+    await usersbox_scheduler.acquire(user_key, SEARCH_PRIORITIES[priority], wait_timeout)
+    try:
+        usersbox_breaker.before_call()
+        started = time.monotonic()
+        failed = True
+        try:
+            response = await hedged_usersbox_get(query, path)
+            # A 429 throttles one key, which the pool rests; it says nothing about Usersbox health
+            failed = response.status_code >= 500
+            return response
+        except Overloaded:
+            # No key was free; that says nothing about Usersbox health
+            failed = None
+            usersbox_breaker.abandon()
+            raise
+        finally:
+            if failed is not None:
+                usersbox_breaker.record(failed, time.monotonic() - started)
+    finally:
+        usersbox_scheduler.release()
+
+def source_search_path(source: Dict[str, Any]) -> str:
+    return f"/{source.get('database')}/{source.get('collection')}/search"
+
+def explain_top_sources(explain_data: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """Explain items with hits, largest first"""
+    items = [item for item in explain_data.get('items', []) if item.get('hits', {}).get('count', 0) > 0]
+    items.sort(key=lambda item: -item['hits']['count'])
+    return items[:limit]
+
+async def fetch_source_hits(
+    explain_item: Dict[str, Any], query: str, user_key: Any, priority: str, wait_timeout: Optional[float]
+) -> Dict[str, Any]:
+    """Full hits for one source, or the explain counts if the source search fails"""
+    try:
+        response = await usersbox_search(
+            query, user_key, priority, wait_timeout, path=source_search_path(explain_item.get('source', {}))
+        )
+        if response.status_code == 200:
+            data = response.json().get('data', {})
+            return {"source": explain_item.get('source', {}), "hits": data.get('hits', data)}
+        log_event(
+            "usersbox", "Source search failed", logging.WARNING,
+            status=response.status_code, source=explain_item.get('source')
+        )
+    except (CircuitOpenError, Overloaded):
+        raise
+    except Exception as e:
+        logging.error(f"Usersbox source search error: {e}")
+    return explain_item
+
+async def usersbox_lookup(
+    query: str, user_key: Any = None, priority: str = "background", wait_timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Dict[str, Any], int, int], Awaitable[None]]] = None
+) -> tuple:
+    """Run a search and return (status_code, results) in the /search response layout.
+
+    on_progress, if given, forces the explain-first path and is awaited with
+    the partial results each time a source completes.
+    """
+    if not USERSBOX_TWO_PHASE and on_progress is None:
+        response = await usersbox_search(query, user_key, priority, wait_timeout)
+        return response.status_code, response.json()
+
+    explain = await usersbox_search(query, user_key, priority, wait_timeout, path="/explain")
+    results = explain.json()
+    data = results.get('data') or {}
+    if explain.status_code != 200 or data.get('count', 0) == 0:
+        USERSBOX_STATS["explain_short_circuits"] += 1
+        return explain.status_code, results
+
+    # Sources keep their explain counts until their hits arrive
+    items = explain_top_sources(data, USERSBOX_TWO_PHASE_TOP_SOURCES)
+    partial = {"status": results.get('status', 'success'), "data": {"count": data['count'], "items": items}}
+    completed = 0
+
+    async def fetch(index: int):
+        nonlocal completed
+        items[index] = await fetch_source_hits(items[index], query, user_key, priority, wait_timeout)
+        completed += 1
+        if on_progress is not None:
+            await on_progress(partial, completed, len(items))
+
+    tasks = [asyncio.ensure_future(fetch(index)) for index in range(len(items))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return 200, partial
+
+def search_found_anything(status_code: int, results: Dict[str, Any]) -> bool:
+    return status_code == 200 and (results.get('data') or {}).get('count', 0) > 0
+
+# Search jobs
+# Searches are persisted as jobs (queued -> running -> done/failed) and run
+# by a pool of workers. A running job whose lease expires, for example
+# because its process crashed, is picked up again by any worker.
+SEARCH_JOB_STATS = {
+    "submitted": 0, "completed": 0, "failed": 0, "shed": 0, "refused": 0, "retried": 0, "running": 0,
+    "progress_edits": 0, "leases_lost": 0
+}
+_search_job_wakeup = asyncio.Event()
+_JOB_LEASE_FIELDS = {"lease_owner": "", "lease_expires_at": ""}
+
+def search_job_priority(source: str, is_admin: bool) -> str:
+    if source == "chat":
+        return "admin" if is_admin else "interactive"
+    return "batch"
+
+async def reserve_search_attempt(user_id: int) -> bool:
+    """Take one attempt before a search is queued, False if the user has none left"""
+    user = await db.users.find_one_and_update(
+        {"telegram_id": user_id, "attempts_remaining": {"$gt": 0}},
+        {"$inc": {"attempts_remaining": -1}},
+        projection={"_id": 1}
+    )
+    return user is not None
+
+async def refund_search_attempt(job: Dict[str, Any]):
+    """Return the attempt reserved for a job that delivered nothing, at most once"""
+    if not job.get("attempt_reserved"):
+        return
+    released = await db.search_jobs.find_one_and_update(
+        {"_id": job["_id"], "attempt_reserved": True},
+        {"$set": {"attempt_reserved": False}}
+    )
+    if released is not None:
+        await db.users.update_one({"telegram_id": job["user_id"]}, {"$inc": {"attempts_remaining": 1}})
+
+async def submit_search_job(
+    query: str, source: str, user_id: Optional[int] = None, chat_id: Optional[int] = None,
+    is_admin: bool = False, attempt_reserved: bool = False, progress_message_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """Persist a search job and wake a worker.
+
+    Jobs are claimed by (priority, fair_seq, created_at). fair_seq is the
+    number of jobs the same user already has waiting, so a user's n-th
+    pending job is claimed after every other user's first n jobs.
+    """
+    priority = search_job_priority(source, is_admin)
+    fair_seq = await db.search_jobs.count_documents(
+        {"user_id": user_id, "status": {"$in": ["queued", "running"]}}
+    )
+    job = {
+        "_id": str(uuid.uuid4()),
+        "status": "queued",
+        "source": source,
+        "query": query,
+        "search_type": detect_search_type(query),
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "is_admin": is_admin,
+        # Refunded if the job fails or is shed
+        "attempt_reserved": attempt_reserved,
+        "progress_message_id": progress_message_id,
+        "priority": SEARCH_PRIORITIES[priority],
+        "fair_seq": fair_seq,
+        "attempts": 0,
+        "created_at": datetime.utcnow()
+    }
+    await db.search_jobs.insert_one(job)
+    SEARCH_JOB_STATS["submitted"] += 1
+    _search_job_wakeup.set()
+    return job
+
+async def claim_search_job() -> Optional[Dict[str, Any]]:
+    """Lease the oldest queued (or abandoned) job to this instance"""
+    now = datetime.utcnow()
+    return await db.search_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_expires_at": {"$lt": now}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "started_at": now,
+                "lease_owner": INSTANCE_ID,
+                "lease_expires_at": now + timedelta(seconds=SEARCH_JOB_LEASE_SECONDS)
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("priority", 1), ("fair_seq", 1), ("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def heartbeat_search_job(job: Dict[str, Any]):
+    """Keep extending the lease while the job runs so no other worker reclaims it"""
+    while True:
+        await asyncio.sleep(SEARCH_JOB_LEASE_SECONDS / 3)
+        try:
+            result = await db.search_jobs.update_one(
+                {"_id": job["_id"], "lease_owner": INSTANCE_ID},
+                {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=SEARCH_JOB_LEASE_SECONDS)}}
+            )
+            if result.matched_count == 0:
+                SEARCH_JOB_STATS["leases_lost"] += 1
+                logging.error(f"Search job {job['_id']} lease lost")
+                return
+        except Exception as e:
+            logging.error(f"Search job heartbeat error: {e}")
+
+async def finish_search_job(job: Dict[str, Any], status: str, **fields) -> bool:
+    """Record the outcome, False if the lease has passed to another worker"""
+    result = await db.search_jobs.update_one(
+        {"_id": job["_id"], "lease_owner": INSTANCE_ID},
+        {"$set": {"status": status, "finished_at": datetime.utcnow(), **fields}, "$unset": _JOB_LEASE_FIELDS}
+    )
+    if result.matched_count == 0:
+        SEARCH_JOB_STATS["leases_lost"] += 1
+        return False
+    SEARCH_JOB_STATS[{"done": "completed", "shed": "shed"}.get(status, "failed")] += 1
+    return True
+
+async def fail_search_job(job: Dict[str, Any], error: str, chat_text: str):
+    if not await finish_search_job(job, "failed", error=error):
+        return
+    await refund_search_attempt(job)
+    if job.get("chat_id"):
+        await edit_telegram_message(job["chat_id"], job.get("progress_message_id"), chat_text)
+
+async def search_queue_full() -> bool:
+    """Whether new searches should be refused instead of queued"""
+    queued = await db.search_jobs.count_documents({"status": "queued"}, limit=SEARCH_QUEUE_MAX_DEPTH)
+    return queued >= SEARCH_QUEUE_MAX_DEPTH
+
+def search_job_wait_budget(job: Dict[str, Any]) -> float:
+    """Seconds a job may still wait for Usersbox"""
+    deadline = SEARCH_QUEUE_DEADLINE_SECONDS if job["source"] == "chat" else SEARCH_API_QUEUE_DEADLINE_SECONDS
+    waited = (datetime.utcnow() - job["created_at"]).total_seconds()
+    return deadline - waited
+
+async def shed_search_job(job: Dict[str, Any], reason: str):
+    if not await finish_search_job(job, "shed", error=reason):
+        return
+    await refund_search_attempt(job)
+    if job.get("chat_id"):
+        await edit_telegram_message(job["chat_id"], job.get("progress_message_id"), BUSY_TEXT)
+
+async def deliver_chat_search(job: Dict[str, Any], status_code: int, results: Dict[str, Any]):
+    """Send results of a chat search, keeping the reserved attempt only if it is chargeable"""
+    formatted_results = format_search_results(results, job["query"], job["search_type"])
+    charge_attempt = status_code == 200 and (
+        SEARCH_CHARGE_EMPTY_RESULTS or search_found_anything(status_code, results)
+    )
+    if not charge_attempt:
+        await refund_search_attempt(job)
+    elif job.get("attempt_reserved"):
+        # Read the balance now, other searches of the same user may have been reserved since
+        user = await db.users.find_one({"telegram_id": job["user_id"]}, {"attempts_remaining": 1})
+        formatted_results += "\n\n" + remaining_attempts_footer(user["attempts_remaining"] if user else 0)
+
+    await queue_telegram_message(
+        job["chat_id"], formatted_results,
+        edit_message_id=job.get("progress_message_id"), outbox_id=f"search:{job['_id']}"
+    )
+
+    # Save search record and update counters
+    search = Search(
+        user_id=job["user_id"],
+        query=job["query"],
+        search_type=job["search_type"],
+        results=results,
+        success=status_code == 200
+    )
+    await record_search(search, search_id=job["_id"])
+
+def search_progress_callback(job: Dict[str, Any]) -> Optional[Callable[[Dict[str, Any], int, int], Awaitable[None]]]:
+    """Throttled placeholder edits for progressive chat searches"""
+    if not (SEARCH_PROGRESSIVE and job["source"] == "chat" and job.get("progress_message_id")):
+        return None
+    last_edit = 0.0
+
+    async def on_progress(results: Dict[str, Any], completed: int, total: int):
+        nonlocal last_edit
+        now = time.monotonic()
+        # The final message is delivered through the outbox
+        if completed >= total or now - last_edit < SEARCH_PROGRESS_EDIT_INTERVAL_SECONDS:
+            return
+        last_edit = now
+        text = format_search_results(results, job["query"], job["search_type"])
+        text += f"\n\n⏳ Загружено источников: {completed} из {total}..."
+        payload = build_message_payload(job["chat_id"], text)
+        payload["message_id"] = job["progress_message_id"]
+        try:
+            # Best effort: a lost progress edit is replaced by the final result anyway
+            await call_telegram_api("editMessageText", payload)
+            SEARCH_JOB_STATS["progress_edits"] += 1
+        except Exception as e:
+            logging.error(f"Search progress edit failed: {e}")
+
+    return on_progress
+
+async def run_search_job(job: Dict[str, Any]):
+    if job["attempts"] > SEARCH_JOB_MAX_ATTEMPTS:
+        await fail_search_job(
+            job, "Too many attempts",
+            "❌ Произошла ошибка при поиске\n\n"
+            "Попробуйте еще раз или обратитесь к администратору."
+        )
+        return
+    if job["attempts"] > 1:
+        SEARCH_JOB_STATS["retried"] += 1
+
+    wait_budget = search_job_wait_budget(job)
+    if wait_budget <= 0:
+        await shed_search_job(job, "Queue deadline exceeded")
+        return
+
+    SEARCH_JOB_STATS["running"] += 1
+    heartbeat = asyncio.create_task(heartbeat_search_job(job))
+    try:
+        status_code, results = await usersbox_lookup(
+            job["query"],
+            user_key=job.get("user_id") or job["_id"],
+            priority=search_job_priority(job["source"], job["is_admin"]),
+            wait_timeout=wait_budget,
+            on_progress=search_progress_callback(job)
+        )
+
+        if job["source"] == "chat":
+            await deliver_chat_search(job, status_code, results)
+            await finish_search_job(job, "done", http_status=status_code)
+        elif status_code == 200:
+            await finish_search_job(job, "done", http_status=status_code, result=results)
+        else:
+            await finish_search_job(job, "failed", http_status=status_code, error=json.dumps(results)[:500])
+    except Overloaded as e:
+        await shed_search_job(job, str(e))
+    except CircuitOpenError as e:
+        await fail_search_job(job, str(e), USERSBOX_UNAVAILABLE_TEXT)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Usersbox API error: {e}")
+        await fail_search_job(
+            job, str(e),
+            "❌ Ошибка при выполнении поиска\n\n"
+            "Сервис временно недоступен. Попробуйте позже."
+        )
+    except Exception as e:
+        logging.error(f"Search error: {e}")
+        await fail_search_job(
+            job, str(e),
+            "❌ Произошла ошибка при поиске\n\n"
+            "Попробуйте еще раз или обратитесь к администратору."
+        )
+    finally:
+        heartbeat.cancel()
+        SEARCH_JOB_STATS["running"] -= 1
+
+async def search_worker():
+    while True:
+        _search_job_wakeup.clear()
+        try:
+            job = await claim_search_job()
+        except Exception as e:
+            logging.error(f"Search job claim error: {e}")
+            job = None
+
+        if job is not None:
+            try:
+                await run_search_job(job)
+            except Exception as e:
+                logging.error(f"Search job {job['_id']} error: {e}")
+            continue
+
+        try:
+            await asyncio.wait_for(_search_job_wakeup.wait(), timeout=SEARCH_JOB_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+async def search_job_queue_position(job: Dict[str, Any]) -> int:
+    """Number of queued jobs that will be claimed before this one"""
+    priority, fair_seq = job.get("priority", 0), job.get("fair_seq", 0)
+    return await db.search_jobs.count_documents({
+        "status": "queued",
+        "$or": [
+            {"priority": {"$lt": priority}},
+            {"priority": priority, "fair_seq": {"$lt": fair_seq}},
+            {"priority": priority, "fair_seq": fair_seq, "created_at": {"$lt": job["created_at"]}}
+        ]
+    })
+
+def serialize_search_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": job["_id"],
+        "status": job["status"],
+        "query": job["query"],
+        "search_type": job["search_type"],
+        "created_at": job["created_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "http_status": job.get("http_status"),
+        "error": job.get("error"),
+        "result": job.get("result")
+    }
+
+# Telegram update decoding
+# The webhook body is read once, parsed with orjson when installed and
+# mapped onto slotted records holding only the fields the bot reads.
+json_loads = orjson.loads if orjson is not None else json.loads
+
+class MalformedUpdate(ValueError):
+    """The webhook body is not a Telegram update we can read"""
+
+@dataclass(slots=True)
+class TelegramUser:
+    id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+
+@dataclass(slots=True)
+class TelegramUpdate:
+    update_id: Optional[int]
+    kind: str  # "message", "callback_query" or "other"
+    chat_id: Optional[int] = None
+    sender: Optional[TelegramUser] = None
+    text: str = ''
+    callback_query_id: Optional[str] = None
+    callback_data: Optional[str] = None
+
+def _object(value: Any, name: str) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise MalformedUpdate(f"{name} must be an object")
+    return value
+
+def _typed(value: Any, types: tuple, name: str) -> Any:
+    if value is not None and (not isinstance(value, types) or isinstance(value, bool)):
+        raise MalformedUpdate(f"{name} has the wrong type")
+    return value
+
+def decode_telegram_user(data: Dict[str, Any]) -> Optional[TelegramUser]:
+    user_id = _typed(data.get('id'), (int,), "from.id")
+    if user_id is None:
+        return None
+    return TelegramUser(
+        id=user_id,
+        username=_typed(data.get('username'), (str,), "from.username"),
+        first_name=_typed(data.get('first_name'), (str,), "from.first_name"),
+        last_name=_typed(data.get('last_name'), (str,), "from.last_name")
+    )
+
+def update_from_dict(data: Any) -> TelegramUpdate:
+    """Map a decoded Update object onto a TelegramUpdate, checking field types"""
+    data = _object(data, "update")
+    update_id = _typed(data.get('update_id'), (int,), "update_id")
+
+    # Handle callback queries (button presses)
+    if 'callback_query' in data:
+        callback_query = _object(data['callback_query'], "callback_query")
+        message = _object(callback_query.get('message'), "callback_query.message")
+        return TelegramUpdate(
+            update_id=update_id,
+            kind="callback_query",
+            chat_id=_typed(_object(message.get('chat'), "chat").get('id'), (int,), "chat.id"),
+            sender=decode_telegram_user(_object(callback_query.get('from'), "from")),
+            callback_query_id=_typed(callback_query.get('id'), (str,), "callback_query.id"),
+            callback_data=_typed(callback_query.get('data'), (str,), "callback_query.data")
+        )
+
+    if 'message' in data:
+        message = _object(data['message'], "message")
+        return TelegramUpdate(
+            update_id=update_id,
+            kind="message",
+            chat_id=_typed(_object(message.get('chat'), "chat").get('id'), (int,), "chat.id"),
+            sender=decode_telegram_user(_object(message.get('from'), "from")),
+            text=_typed(message.get('text'), (str,), "message.text") or ''
+        )
+    return TelegramUpdate(update_id=update_id, kind="other")
+
+def decode_update(body: bytes) -> TelegramUpdate:
+    if len(body) > WEBHOOK_MAX_BODY_BYTES:
+        raise MalformedUpdate("Update is too large")
+    try:
+        data = json_loads(body)
+    except ValueError as e:
+        raise MalformedUpdate(f"Invalid JSON: {e}")
+    return update_from_dict(data)
+
+async def read_webhook_body(request: Request) -> bytes:
+    """Read the request body once, giving up as soon as it exceeds the limit"""
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > WEBHOOK_MAX_BODY_BYTES:
+        raise MalformedUpdate("Update is too large")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > WEBHOOK_MAX_BODY_BYTES:
+            raise MalformedUpdate("Update is too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Command routing
+SUBSCRIPTION_KEYBOARD = {
+    "inline_keyboard": [
+        [
+            {"text": "📢 Подписаться на канал", "url": "https://t.me/uzri_sebya"}
+        ],
+        [
+            {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
+        ]
+    ]
+}
+
+NO_ATTEMPTS_TEXT = (
+    "❌ У вас закончились попытки поиска!\n\n"
+    "🔗 Пригласите друзей по реферальной ссылке, чтобы получить больше попыток.\n"
+    "Используйте /referral для получения ссылки."
+)
+
+@dataclass
+class Route:
+    """Declarative description of a bot command or callback handler"""
+    handler: Callable[['UpdateContext'], Awaitable[None]]
+    admin_only: bool = False
+    require_subscription: bool = False
+    require_attempts: bool = False
+    limit_class: str = "command"
+    subscription_text: Optional[str] = None
+
+@dataclass
+class UpdateContext:
+    """Per-update state shared by the middleware chain and the handler"""
+    update: TelegramUpdate
+    chat_id: int
+    sender: TelegramUser
+    text: str = ''
+    args: str = ''
+    route: Optional[Route] = None
+    callback_data: Optional[str] = None
+    user: Optional[User] = None
+    _subscribed: Optional[bool] = field(default=None, repr=False)
+
+    async def is_subscribed(self) -> bool:
+        """Subscription status, fetched from Telegram at most once per update"""
+        if self._subscribed is None:
+            self._subscribed = await check_subscription(self.sender.id)
+        return self._subscribed
 
-        # Check if referral already exists
-        existing_referral = await db.referrals.find_one({
-            "referrer_id": referrer['telegram_id'],
-            "referred_id": referred_user_id
-        })
-        if existing_referral:
-            return False
+Middleware = Callable[[UpdateContext, Callable[[], Awaitable[None]]], Awaitable[None]]
 
-        # Create referral record
-        referral = Referral(
-            referrer_id=referrer['telegram_id'],
-            referred_id=referred_user_id
-        )
-        await db.referrals.insert_one(referral.dict())
+class CommandRouter:
+    """Dispatch updates to registered handlers through a middleware chain"""
 
-        # Give attempt to referrer and update referral count
-        await db.users.update_one(
-            {"telegram_id": referrer['telegram_id']},
-            {
-                "$inc": {
-                    "attempts_remaining": 1,
-                    "total_referrals": 1
-                }
-            }
-        )
+    def __init__(self):
+        self.commands: Dict[str, Route] = {}
+        self.callbacks: Dict[str, Route] = {}
+        self.fallback_route: Optional[Route] = None
+        self.middlewares: List[Middleware] = []
 
-        # Give 1 attempt to referred user
-        await db.users.update_one(
-            {"telegram_id": referred_user_id},
-            {
-                "$set": {"referred_by": referrer['telegram_id']},
-                "$inc": {"attempts_remaining": 1}
-            }
+    def command(self, name: str, **options):
+        def decorator(handler):
+            self.commands[name] = Route(handler=handler, **options)
+            return handler
+        return decorator
+
+    def callback(self, data: str, **options):
+        def decorator(handler):
+            self.callbacks[data] = Route(handler=handler, **options)
+            return handler
+        return decorator
+
+    def fallback(self, **options):
+        def decorator(handler):
+            self.fallback_route = Route(handler=handler, **options)
+            return handler
+        return decorator
+
+    def middleware(self, func: Middleware) -> Middleware:
+        self.middlewares.append(func)
+        return func
+
+    def resolve(self, ctx: UpdateContext):
+        """Pick the route for a message with a single dictionary lookup"""
+        if ctx.callback_data is not None:
+            ctx.route = self.callbacks.get(ctx.callback_data)
+            return
+        if ctx.text.startswith('/'):
+            parts = ctx.text.split(maxsplit=1)
+            name = parts[0][1:].split('@', 1)[0].lower()
+            route = self.commands.get(name)
+            if route:
+                ctx.route = route
+                ctx.args = parts[1].strip() if len(parts) > 1 else ''
+                return
+        ctx.route = self.fallback_route
+        ctx.args = ctx.text.strip()
+
+    async def dispatch(self, ctx: UpdateContext):
+        if ctx.route is None:
+            self.resolve(ctx)
+        if ctx.route is None:
+            return
+
+        async def call(index: int):
+            if index < len(self.middlewares):
+                await self.middlewares[index](ctx, lambda: call(index + 1))
+            else:
+                await ctx.route.handler(ctx)
+
+        await call(0)
+
+bot_router = CommandRouter()
+
+@bot_router.middleware
+async def load_user_middleware(ctx: UpdateContext, call_next):
+    async with mongo_bulkhead.slot():
+        ctx.user = await get_or_create_user(
+            telegram_id=ctx.sender.id,
+            username=ctx.sender.username,
+            first_name=ctx.sender.first_name,
+            last_name=ctx.sender.last_name
         )
+    await call_next()
 
-        # Notify referrer
+@bot_router.middleware
+async def admin_gate_middleware(ctx: UpdateContext, call_next):
+    # Admin commands from regular users are treated as plain text
+    if ctx.route.admin_only and not ctx.user.is_admin:
+        ctx.route = bot_router.fallback_route
+        ctx.args = ctx.text.strip()
+    await call_next()
+
+@bot_router.middleware
+async def subscription_gate_middleware(ctx: UpdateContext, call_next):
+    if ctx.route.require_subscription and not ctx.user.is_admin and not await ctx.is_subscribed():
         await send_telegram_message(
-            referrer['telegram_id'],
-            f"🎉 *Поздравляем!* Пользователь присоединился по вашей реферальной ссылке!\n\n"
-            f"💎 Вы получили +1 попытку поиска\n"
-            f"👥 Всего рефералов: {referrer['total_referrals'] + 1}"
+            ctx.chat_id,
+            ctx.route.subscription_text or
+            "🔒 Для использования бота необходимо подписаться на канал!\n\n"
+            "📢 Подпишитесь на @uzri_sebya и нажмите 'Проверить подписку'",
+            reply_markup=SUBSCRIPTION_KEYBOARD
         )
+        return
+    await call_next()
+
+@bot_router.middleware
+async def attempt_gate_middleware(ctx: UpdateContext, call_next):
+    if ctx.route.require_attempts and ctx.args and not ctx.user.is_admin and ctx.user.attempts_remaining <= 0:
+        await send_telegram_message(ctx.chat_id, NO_ATTEMPTS_TEXT)
+        return
+    await call_next()
+
+# Anti-flood limiting
+# Token buckets keyed by (telegram_id, command class) are checked before any
+# database or Bot API work is done for an update.
+FLOOD_STATS = {"allowed": 0, "limited": 0, "notices": 0, "backend_errors": 0}
+
+def parse_flood_limits(spec: str) -> Dict[str, tuple]:
+    """Parse "class=rate:burst" pairs"""
+    limits = {}
+    for pair in spec.split(','):
+        if '=' not in pair or ':' not in pair:
+            continue
+        limit_class, values = pair.split('=', 1)
+        rate, burst = values.split(':', 1)
+        try:
+            limits[limit_class.strip()] = (float(rate), float(burst))
+        except ValueError:
+            continue
+    return limits
+
+class FloodLimiter:
+    """Per-user token bucket limiter kept in the shared state backend"""
+
+    def __init__(self, limits: Dict[str, tuple], backend: StateBackend):
+        self.limits = limits
+        self.backend = backend
+        # Used only while the shared backend is unreachable
+        self.local = MemoryStateBackend()
+
+    async def allow(self, user_id: int, limit_class: str) -> bool:
+        limit = self.limits.get(limit_class)
+        if limit is None:
+            return True
+        rate, burst = limit
+        key = f"flood:{limit_class}:{user_id}"
+        try:
+            return await self.backend.take_token(key, rate, burst)
+        except Exception as e:
+            FLOOD_STATS["backend_errors"] += 1
+            logging.error(f"Flood limiter backend error: {e}")
+        return await self.local.take_token(key, rate, burst)
+
+    async def should_notify(self, user_id: int) -> bool:
+        key = f"flood-notice:{user_id}"
+        try:
+            return await self.backend.set_if_absent(key, "1", FLOOD_NOTICE_INTERVAL_SECONDS)
+        except Exception as e:
+            FLOOD_STATS["backend_errors"] += 1
+            logging.error(f"Flood limiter backend error: {e}")
+        return await self.local.set_if_absent(key, "1", FLOOD_NOTICE_INTERVAL_SECONDS)
+
+flood_limiter = FloodLimiter(parse_flood_limits(FLOOD_LIMITS), state_backend)
+
+async def check_flood(ctx: UpdateContext) -> bool:
+    """Return False (and maybe send a short notice) if the user is over the limit"""
+    if ctx.route is None or ctx.sender.username == ADMIN_USERNAME:
+        return True
+    user_id = ctx.sender.id
+    if await flood_limiter.allow(user_id, ctx.route.limit_class):
+        FLOOD_STATS["allowed"] += 1
+        return True
+
+    FLOOD_STATS["limited"] += 1
+    if await flood_limiter.should_notify(user_id):
+        FLOOD_STATS["notices"] += 1
+        run_in_background(send_telegram_message(
+            ctx.chat_id,
+            "⏳ Слишком много запросов. Подождите немного и попробуйте снова."
+        ))
+    return False
 
+# Update deduplication
+DEDUP_STATS = {"duplicates_state": 0, "duplicates_db": 0, "claimed": 0, "released": 0, "errors": 0}
+
+async def claim_update(update_id: Optional[int]) -> bool:
+    """Claim an update for processing, returning False if it was already seen"""
+    if update_id is None:
         return True
+    # The state backend turns away redeliveries without a database round trip
+    try:
+        fresh = await state_backend.set_if_absent(f"update:{update_id}", "1", UPDATE_DEDUP_TTL_SECONDS)
     except Exception as e:
-        logging.error(f"Referral processing error: {e}")
+        STATE_STATS["errors"] += 1
+        logging.error(f"Update dedup state error: {e}")
+        fresh = True
+    if not fresh:
+        DEDUP_STATS["duplicates_state"] += 1
+        return False
+
+    # The unique index makes the claim atomic across replicas
+    try:
+        await db.processed_updates.insert_one({"update_id": update_id, "created_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        DEDUP_STATS["duplicates_db"] += 1
         return False
+    except Exception as e:
+        # Prefer processing twice over dropping the update when Mongo is unavailable
+        DEDUP_STATS["errors"] += 1
+        logging.error(f"Update dedup claim failed: {e}")
+        return True
+
+    DEDUP_STATS["claimed"] += 1
+    return True
+
+async def release_update(update_id: Optional[int]):
+    """Forget a claim so Telegram's redelivery of a failed update is processed"""
+    if update_id is None:
+        return
+    DEDUP_STATS["released"] += 1
+    try:
+        await state_backend.delete(f"update:{update_id}")
+    except Exception as e:
+        STATE_STATS["errors"] += 1
+        logging.error(f"Update dedup state error: {e}")
+    try:
+        await db.processed_updates.delete_one({"update_id": update_id})
+    except Exception as e:
+        DEDUP_STATS["errors"] += 1
+        logging.error(f"Update dedup release failed: {e}")
 
 # API Routes
 @api_router.get("/")
@@ -386,199 +3502,131 @@ async def root():
 @api_router.post("/webhook/{secret}")
 async def telegram_webhook(secret: str, request: Request):
     """Handle Telegram webhook"""
-    logging.info(f"Webhook called with secret: {secret}")
-    
-    if secret != WEBHOOK_SECRET:
-        logging.error(f"Invalid webhook secret received: {secret}, expected: {WEBHOOK_SECRET}")
+    if not secrets.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        log_event(
+            "webhook", "Invalid webhook secret received", logging.WARNING,
+            client=request.client.host if request.client else None
+        )
         raise HTTPException(status_code=403, detail="Invalid webhook secret")
     
     try:
-        raw_body = await request.body()
-        logging.info(f"Raw webhook body: {raw_body}")
-        
-        update_data = await request.json()
-        logging.info(f"Parsed webhook data: {update_data}")
-        
-        await handle_telegram_update(update_data)
+        update = decode_update(await read_webhook_body(request))
+    except MalformedUpdate as e:
+        # Telegram redelivers anything but a 2xx, so a bad update is dropped with a 200
+        log_event(
+            "webhook", "Dropped malformed update", logging.WARNING,
+            error=str(e), content_length=request.headers.get('content-length')
+        )
+        return {"status": "ignored"}
+
+    try:
+        await handle_telegram_update(update)
         return {"status": "ok"}
     except Exception as e:
         logging.error(f"Webhook processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
 
-async def handle_callback_query(callback_query: Dict[str, Any]):
-    """Handle callback queries from inline keyboard buttons"""
-    chat_id = callback_query.get('message', {}).get('chat', {}).get('id')
-    user_id = callback_query.get('from', {}).get('id')
-    data = callback_query.get('data')
-    callback_query_id = callback_query.get('id')
-    
-    if not chat_id or not user_id or not data:
-        logging.error("Missing required callback data")
-        return
-    
-    # Answer callback query to remove loading
+async def answer_callback_query(callback_query_id: str):
+    """Answer callback query to remove the loading indicator"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery"
-        requests.post(url, json={"callback_query_id": callback_query_id}, timeout=5)
+        await call_telegram_api("answerCallbackQuery", {"callback_query_id": callback_query_id}, timeout=5)
     except Exception as e:
         logging.error(f"Failed to answer callback query: {e}")
-    
-    if data == "check_subscription":
-        # Get user
-        user = await get_or_create_user(
-            telegram_id=user_id,
-            username=callback_query.get('from', {}).get('username'),
-            first_name=callback_query.get('from', {}).get('first_name'),
-            last_name=callback_query.get('from', {}).get('last_name')
+
+def parse_update(update: TelegramUpdate) -> Optional[UpdateContext]:
+    """Build the per-update context without any I/O"""
+    if update.kind == "callback_query":
+        if not update.chat_id or update.sender is None or not update.callback_data:
+            logging.error("Missing required callback data")
+            return None
+        return UpdateContext(
+            update=update, chat_id=update.chat_id, sender=update.sender, callback_data=update.callback_data
         )
-        
-        # Check subscription
-        is_subscribed = await check_subscription(user_id)
-        if is_subscribed:
-            # Update user subscription status
-            await db.users.update_one(
-                {"telegram_id": user_id},
-                {"$set": {"is_subscribed": True}}
-            )
-            
-            await send_telegram_message(
-                chat_id,
-                "✅ Подписка подтверждена!\n\n"
-                "🎉 Теперь вы можете пользоваться всеми функциями бота!\n"
-                "💡 Отправьте любой запрос для поиска или используйте команду /help"
-            )
-        else:
-            keyboard = {
-                "inline_keyboard": [
-                    [
-                        {"text": "📢 Подписаться на канал", "url": "https://t.me/uzri_sebya"}
-                    ],
-                    [
-                        {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
-                    ]
-                ]
-            }
-            
-            await send_telegram_message(
-                chat_id,
-                "❌ Подписка не найдена\n\n"
-                "📢 Подпишитесь на канал @uzri_sebya и нажмите 'Проверить подписку' снова",
-                reply_markup=keyboard
-            )
 
-async def handle_telegram_update(update_data: Dict[str, Any]):
+    if update.kind != "message":
+        log_event("telegram.update", "No message in update", update_id=update.update_id)
+        return None
+
+    log_event("telegram.update", "Processing message", chat_id=update.chat_id, text=update.text)
+
+    if not update.chat_id:
+        logging.error("No chat_id in message")
+        return None
+    # Messages without a sender (channel posts) are attributed to the chat
+    sender = update.sender or TelegramUser(id=update.chat_id)
+    return UpdateContext(update=update, chat_id=update.chat_id, sender=sender, text=update.text)
+
+async def handle_telegram_update(update: TelegramUpdate):
     """Process incoming Telegram update"""
-    logging.info(f"Received telegram update: {update_data}")
-    
-    # Handle callback queries (button presses)
-    callback_query = update_data.get('callback_query')
-    if callback_query:
-        await handle_callback_query(callback_query)
-        return
-    
-    message = update_data.get('message')
-    if not message:
-        logging.info("No message in update")
+    log_event("telegram.update", "Received telegram update", update_id=update.update_id, kind=update.kind)
+
+    ctx = parse_update(update)
+    if ctx is None:
         return
 
-    chat = message.get('chat', {})
-    chat_id = chat.get('id')
-    text = message.get('text', '')
-    user_info = message.get('from', {})
-    
-    logging.info(f"Processing message: chat_id={chat_id}, text='{text}', user={user_info.get('username', 'unknown')}")
-    
-    if not chat_id:
-        logging.error("No chat_id in message")
+    # Anti-flood runs first, before any database or Bot API call
+    bot_router.resolve(ctx)
+    if not await check_flood(ctx):
         return
 
-    # Get or create user
-    user = await get_or_create_user(
-        telegram_id=user_info.get('id', chat_id),
-        username=user_info.get('username'),
-        first_name=user_info.get('first_name'),
-        last_name=user_info.get('last_name')
-    )
+    try:
+        async with mongo_bulkhead.slot():
+            claimed = await claim_update(update.update_id)
+        if not claimed:
+            log_event("telegram.update", "Dropped duplicate update", update_id=update.update_id)
+            return
 
-    # Handle commands
-    if text.startswith('/start'):
-        await handle_start_command(chat_id, text, user)
-    elif text.startswith('/search'):
-        await handle_search_command(chat_id, text, user)
-    elif text.startswith('/balance'):
-        await handle_balance_command(chat_id, user)
-    elif text.startswith('/referral'):
-        await handle_referral_command(chat_id, user)
-    elif text.startswith('/help'):
-        await handle_help_command(chat_id, user)
-    elif text.startswith('/capabilities'):
-        await handle_capabilities_command(chat_id, user)
-    elif text.startswith('/admin') and user.is_admin:
-        await handle_admin_command(chat_id, text, user)
-    elif text.startswith('/give') and user.is_admin:
-        await handle_give_attempts_command(chat_id, text, user)
-    elif text.startswith('/stats') and user.is_admin:
-        await handle_stats_command(chat_id, user)
-    else:
-        # Check subscription first
-        if not user.is_admin:
-            is_subscribed = await check_subscription(user.telegram_id)
-            if not is_subscribed:
-                keyboard = {
-                    "inline_keyboard": [
-                        [
-                            {"text": "📢 Подписаться на канал", "url": "https://t.me/uzri_sebya"}
-                        ],
-                        [
-                            {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
-                        ]
-                    ]
-                }
-                
-                await send_telegram_message(
-                    chat_id,
-                    "🔒 *Для использования бота необходимо подписаться на канал!*\n\n"
-                    "📢 Подпишитесь на канал @uzri_sebya и нажмите 'Проверить подписку'\n\n"
-                    "💡 После подписки вы сможете пользоваться всеми функциями бота!",
-                    reply_markup=keyboard
-                )
-                return
+        try:
+            if ctx.callback_data is not None:
+                await answer_callback_query(update.callback_query_id)
+            await bot_router.dispatch(ctx)
+        except Exception:
+            # The webhook answers 500 and Telegram redelivers; the retry must not be
+            # taken for a duplicate
+            await release_update(update.update_id)
+            raise
+    except Overloaded as e:
+        # Shed the update with a fast reply instead of queueing it behind the backlog
+        log_event("admission", "Update shed", logging.WARNING, dependency=e.name, chat_id=ctx.chat_id)
+        run_in_background(send_telegram_message(ctx.chat_id, BUSY_TEXT))
+
+@bot_router.callback("check_subscription", limit_class="callback")
+async def handle_check_subscription_callback(ctx: UpdateContext):
+    """Handle the 'check subscription' inline button"""
+    if await ctx.is_subscribed():
+        # Update user subscription status
+        await db.users.update_one(
+            {"telegram_id": ctx.user.telegram_id},
+            {"$set": {"is_subscribed": True}}
+        )
         
-        # Treat as search query if user has attempts
-        if user.attempts_remaining > 0 or user.is_admin:
-            await handle_search_command(chat_id, f"/search {text}", user)
-        else:
-            await send_telegram_message(
-                chat_id,
-                "❌ У вас закончились попытки поиска!\n\n"
-                "🔗 Пригласите друзей по реферальной ссылке, чтобы получить больше попыток.\n"
-                "Используйте /referral для получения ссылки."
-            )
+        await send_telegram_message(
+            ctx.chat_id,
+            "✅ Подписка подтверждена!\n\n"
+            "🎉 Теперь вы можете пользоваться всеми функциями бота!\n"
+            "💡 Отправьте любой запрос для поиска или используйте команду /help"
+        )
+    else:
+        await send_telegram_message(
+            ctx.chat_id,
+            "❌ Подписка не найдена\n\n"
+            "📢 Подпишитесь на канал @uzri_sebya и нажмите 'Проверить подписку' снова",
+            reply_markup=SUBSCRIPTION_KEYBOARD
+        )
 
-async def handle_start_command(chat_id: int, text: str, user: User):
+@bot_router.command("start")
+async def handle_start_command(ctx: UpdateContext):
     """Handle /start command with enhanced welcome"""
+    chat_id, user = ctx.chat_id, ctx.user
     # Check for referral code
-    parts = text.split()
     referral_bonus = False
-    if len(parts) > 1:
-        referral_code = parts[1]
+    if ctx.args:
+        referral_code = ctx.args.split()[0]
         referral_bonus = await process_referral(user.telegram_id, referral_code)
     
     # Check subscription for non-admin users
     if not user.is_admin:
-        is_subscribed = await check_subscription(user.telegram_id)
-        if not is_subscribed:
-            keyboard = {
-                "inline_keyboard": [
-                    [
-                        {"text": "📢 Подписаться на канал", "url": "https://t.me/uzri_sebya"}
-                    ],
-                    [
-                        {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
-                    ]
-                ]
-            }
-            
+        if not await ctx.is_subscribed():
             welcome_text = "🔍 ДОБРО ПОЖАЛОВАТЬ В USERSBOX BOT! 🔍\n\n"
             welcome_text += "🎯 ЧТО УМЕЕТ ЭТОТ БОТ?\n"
             welcome_text += "Этот бот поможет вам найти информацию о себе или близких из открытых источников в интернете. Узнайте, какие данные о вас попали в различные утечки и базы данных.\n\n"
@@ -586,7 +3634,7 @@ async def handle_start_command(chat_id: int, text: str, user: User):
             welcome_text += "Для использования бота необходимо подписаться на наш канал!\n\n"
             welcome_text += "📢 Подпишитесь на @uzri_sebya и нажмите 'Проверить подписку'"
             
-            await send_telegram_message(chat_id, welcome_text, reply_markup=keyboard)
+            await send_telegram_message(chat_id, welcome_text, reply_markup=SUBSCRIPTION_KEYBOARD)
             return
 
     # Create simple welcome message without complex formatting
@@ -642,8 +3690,10 @@ async def handle_start_command(chat_id: int, text: str, user: User):
 
     await send_telegram_message(chat_id, welcome_text)
 
-async def handle_capabilities_command(chat_id: int, user: User):
+@bot_router.command("capabilities")
+async def handle_capabilities_command(ctx: UpdateContext):
     """Handle capabilities command - detailed list of search capabilities"""
+    chat_id = ctx.chat_id
     cap_text = "🎯 *═══════════════════════════*\n"
     cap_text += " 🔍 *ВОЗМОЖНОСТИ ПОИСКА*\n"
     cap_text += "*═══════════════════════════* 🎯\n\n"
@@ -706,10 +3756,31 @@ async def handle_capabilities_command(chat_id: int, user: User):
     
     await send_telegram_message(chat_id, cap_text)
 
-async def handle_search_command(chat_id: int, text: str, user: User):
+@bot_router.fallback(
+    require_subscription=True,
+    require_attempts=True,
+    limit_class="search",
+    subscription_text=(
+        "🔒 *Для использования бота необходимо подписаться на канал!*\n\n"
+        "📢 Подпишитесь на канал @uzri_sebya и нажмите 'Проверить подписку'\n\n"
+        "💡 После подписки вы сможете пользоваться всеми функциями бота!"
+    )
+)
+@bot_router.command(
+    "search",
+    require_subscription=True,
+    require_attempts=True,
+    limit_class="search",
+    subscription_text=(
+        "🔒 Для использования поиска необходимо подписаться на канал!\n\n"
+        "📢 Подпишитесь на @uzri_sebya и нажмите 'Проверить подписку'"
+    )
+)
+async def handle_search_command(ctx: UpdateContext):
     """Handle search command with enhanced search type detection"""
-    # Extract query
-    query = text.replace('/search', '', 1).strip()
+    chat_id, user = ctx.chat_id, ctx.user
+    # Subscription, attempts and rate limits are enforced by the router middleware
+    query = ctx.args
     if not query:
         await send_telegram_message(
             chat_id,
@@ -722,39 +3793,6 @@ async def handle_search_command(chat_id: int, text: str, user: User):
         )
         return
 
-    # Check subscription for non-admin users
-    if not user.is_admin:
-        is_subscribed = await check_subscription(user.telegram_id)
-        if not is_subscribed:
-            keyboard = {
-                "inline_keyboard": [
-                    [
-                        {"text": "📢 Подписаться на канал", "url": "https://t.me/uzri_sebya"}
-                    ],
-                    [
-                        {"text": "✅ Проверить подписку", "callback_data": "check_subscription"}
-                    ]
-                ]
-            }
-            
-            await send_telegram_message(
-                chat_id,
-                "🔒 Для использования поиска необходимо подписаться на канал!\n\n"
-                "📢 Подпишитесь на @uzri_sebya и нажмите 'Проверить подписку'",
-                reply_markup=keyboard
-            )
-            return
-
-    # Check attempts
-    if user.attempts_remaining <= 0 and not user.is_admin:
-        await send_telegram_message(
-            chat_id,
-            "❌ У вас закончились попытки поиска!\n\n"
-            "🔗 Пригласите друзей по реферальной ссылке:\n"
-            "Используйте /referral для получения ссылки."
-        )
-        return
-
     # Detect search type
     search_type = detect_search_type(query)
     
@@ -771,7 +3809,28 @@ async def handle_search_command(chat_id: int, text: str, user: User):
     }
     
     search_emoji = type_emojis.get(search_type, "🔍")
-    await send_telegram_message(
+    if not usersbox_breaker.available():
+        usersbox_breaker.rejected += 1
+        await send_telegram_message(chat_id, USERSBOX_UNAVAILABLE_TEXT)
+        return
+    async with mongo_bulkhead.slot():
+        queue_full = await search_queue_full()
+    if queue_full:
+        SEARCH_JOB_STATS["refused"] += 1
+        await send_telegram_message(chat_id, BUSY_TEXT)
+        return
+
+    # The gate middleware saw the balance before earlier searches were queued,
+    # so the attempt is taken atomically here and refunded if the job fails
+    attempt_reserved = False
+    if not user.is_admin:
+        if not await reserve_search_attempt(user.telegram_id):
+            await send_telegram_message(chat_id, NO_ATTEMPTS_TEXT)
+            return
+        attempt_reserved = True
+
+    # The placeholder is edited in place with the results and attempts footer
+    progress_message_id = await post_telegram_message(
         chat_id, 
         f"{search_emoji} Выполняю поиск...\n"
         f"🔍 Тип: {search_type}\n"
@@ -779,76 +3838,34 @@ async def handle_search_command(chat_id: int, text: str, user: User):
     )
 
     try:
-        # Call usersbox API
-        headers = {"Authorization": USERSBOX_TOKEN}
-        response = requests.get(
-            f"{USERSBOX_BASE_URL}/search",
-            headers=headers,
-            params={"q": query},
-            timeout=30
-        )
-
-        results = response.json()
-
-        # Format and send results
-        formatted_results = format_search_results(results, query, search_type)
-        await send_telegram_message(chat_id, formatted_results)
-
-        # Save search record
-        search = Search(
+        # Results are delivered by a search worker, so the update returns immediately
+        await submit_search_job(
+            query, "chat",
             user_id=user.telegram_id,
-            query=query,
-            search_type=search_type,
-            results=results,
-            success=response.status_code == 200
-        )
-        await db.searches.insert_one(search.dict())
-
-        # Deduct attempt (except for admin)
-        if not user.is_admin and response.status_code == 200:
-            await db.users.update_one(
-                {"telegram_id": user.telegram_id},
-                {"$inc": {"attempts_remaining": -1}}
-            )
-            
-            # Update user object
-            user.attempts_remaining -= 1
-
-            # Show remaining attempts
-            if user.attempts_remaining > 0:
-                await send_telegram_message(
-                    chat_id,
-                    f"💎 Осталось попыток: {user.attempts_remaining}"
-                )
-            else:
-                await send_telegram_message(
-                    chat_id,
-                    "❌ Попытки закончились!\n\n"
-                    "🔗 Получите больше попыток, пригласив друзей:\n"
-                    "Используйте /referral"
-                )
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Usersbox API error: {e}")
-        await send_telegram_message(
-            chat_id,
-            "❌ Ошибка при выполнении поиска\n\n"
-            "Сервис временно недоступен. Попробуйте позже."
+            chat_id=chat_id,
+            is_admin=user.is_admin,
+            attempt_reserved=attempt_reserved,
+            progress_message_id=progress_message_id
         )
     except Exception as e:
         logging.error(f"Search error: {e}")
-        await send_telegram_message(
+        if attempt_reserved:
+            await db.users.update_one({"telegram_id": user.telegram_id}, {"$inc": {"attempts_remaining": 1}})
+        await edit_telegram_message(
             chat_id,
+            progress_message_id,
             "❌ Произошла ошибка при поиске\n\n"
             "Попробуйте еще раз или обратитесь к администратору."
         )
 
-async def handle_balance_command(chat_id: int, user: User):
+@bot_router.command("balance")
+async def handle_balance_command(ctx: UpdateContext):
     """Handle balance command with enhanced statistics"""
-    # Get user's search history
-    recent_searches = await db.searches.find({"user_id": user.telegram_id}).sort("timestamp", -1).limit(5).to_list(5)
-    total_searches = await db.searches.count_documents({"user_id": user.telegram_id})
-    successful_searches = await db.searches.count_documents({"user_id": user.telegram_id, "success": True})
+    chat_id, user = ctx.chat_id, ctx.user
+    # Counters live on the user document loaded by the router
+    recent_searches = list(reversed(user.recent_searches))
+    total_searches = user.total_searches
+    successful_searches = user.successful_searches
 
     balance_text = "💰 *═══════════════════════════*\n"
     balance_text += " 💎 *ВАШ БАЛАНС И СТАТИСТИКА*\n"
@@ -910,13 +3927,14 @@ async def handle_balance_command(chat_id: int, user: User):
 
     await send_telegram_message(chat_id, balance_text)
 
-async def handle_referral_command(chat_id: int, user: User):
+@bot_router.command("referral")
+async def handle_referral_command(ctx: UpdateContext):
     """Handle referral command with enhanced referral system"""
+    chat_id, user = ctx.chat_id, ctx.user
     referral_link = f"https://t.me/{BOT_USERNAME}?start={user.referral_code}"
 
-    # Get referral statistics
-    referrals = await db.referrals.find({"referrer_id": user.telegram_id}).to_list(100)
-    total_earned = len(referrals)
+    # Every referral earns one attempt
+    total_earned = user.total_referrals
 
     referral_text = "🔗 *═══════════════════════════*\n"
     referral_text += " 💰 *РЕФЕРАЛЬНАЯ ПРОГРАММА*\n"
@@ -971,8 +3989,10 @@ async def handle_referral_command(chat_id: int, user: User):
 
     await send_telegram_message(chat_id, referral_text)
 
-async def handle_help_command(chat_id: int, user: User):
+@bot_router.command("help")
+async def handle_help_command(ctx: UpdateContext):
     """Handle help command with comprehensive guide"""
+    chat_id = ctx.chat_id
     help_text = "📖 *═══════════════════════════*\n"
     help_text += " 📚 *ПОДРОБНАЯ СПРАВКА*\n"
     help_text += "*═══════════════════════════* 📖\n\n"
@@ -1032,22 +4052,23 @@ async def handle_help_command(chat_id: int, user: User):
 
     await send_telegram_message(chat_id, help_text)
 
-async def handle_admin_command(chat_id: int, text: str, user: User):
+@bot_router.command("admin", admin_only=True)
+async def handle_admin_command(ctx: UpdateContext):
     """Handle admin commands with enhanced statistics"""
-    # Get system statistics
-    total_users = await db.users.count_documents({})
-    total_searches = await db.searches.count_documents({})
-    total_referrals = await db.referrals.count_documents({})
-    successful_searches = await db.searches.count_documents({"success": True})
-
-    # Recent activity (last 24 hours)
-    from datetime import datetime, timedelta
-    yesterday = datetime.utcnow() - timedelta(days=1)
-    recent_users = await db.users.count_documents({"created_at": {"$gte": yesterday}})
-    recent_searches = await db.searches.count_documents({"timestamp": {"$gte": yesterday}})
+    chat_id, user = ctx.chat_id, ctx.user
+    totals = await get_dashboard_totals()
+    total_users = totals["total_users"]
+    total_searches = totals["total_searches"]
+    total_referrals = totals["total_referrals"]
+    successful_searches = totals["successful_searches"]
+
+    # Recent activity (last 24 hours, hourly resolution from the rollups)
+    last_day = await get_analytics_window(datetime.utcnow() - timedelta(days=1))
+    recent_users = last_day["new_users"]
+    recent_searches = last_day["searches"]
 
     # Top users by referrals
-    top_referrers = await db.users.find().sort("total_referrals", -1).limit(5).to_list(5)
+    top_referrers = await analytics_db.users.find().sort("total_referrals", -1).limit(5).to_list(5)
 
     admin_text = "👑 *═══════════════════════════*\n"
     admin_text += " 🔧 *АДМИН ПАНЕЛЬ*\n"
@@ -1091,18 +4112,28 @@ async def handle_admin_command(chat_id: int, text: str, user: User):
 
     await send_telegram_message(chat_id, admin_text)
 
-async def handle_give_attempts_command(chat_id: int, text: str, user: User):
+@bot_router.command("give", admin_only=True)
+async def handle_give_attempts_command(ctx: UpdateContext):
     """Handle give attempts admin command"""
+    chat_id, text = ctx.chat_id, ctx.text
     parts = text.split()
     if len(parts) != 3:
         await send_telegram_message(
             chat_id,
             "❌ *Неверный формат команды*\n\n"
             "*Использование:* `/give [user_id] [attempts]`\n"
-            "*Пример:* `/give 123456789 5`"
+            "*Пример:* `/give 123456789 5`\n\n"
+            "*Массовая выдача:*\n"
+            "`/give 111,222,333 5` - списку пользователей\n"
+            "`/give active:7 5` - активным за 7 дней\n"
+            "`/give referrals:3 5` - пригласившим от 3 друзей"
         )
         return
 
+    if ',' in parts[1] or ':' in parts[1]:
+        await give_attempts_bulk_command(ctx, parts[1], parts[2])
+        return
+
     try:
         target_user_id = int(parts[1])
         attempts_to_give = int(parts[2])
@@ -1121,6 +4152,7 @@ async def handle_give_attempts_command(chat_id: int, text: str, user: User):
             {"telegram_id": target_user_id},
             {"$inc": {"attempts_remaining": attempts_to_give}}
         )
+        dashboard_cache.invalidate("users")
 
         # Notify admin
         await send_telegram_message(
@@ -1129,7 +4161,7 @@ async def handle_give_attempts_command(chat_id: int, text: str, user: User):
         )
 
         # Notify user
-        await send_telegram_message(
+        await queue_telegram_message(
             target_user_id,
             f"🎁 *Вам выданы попытки!*\n\n"
             f"💎 Получено попыток: {attempts_to_give}\n"
@@ -1148,28 +4180,71 @@ async def handle_give_attempts_command(chat_id: int, text: str, user: User):
             "❌ Ошибка при выдаче попыток"
         )
 
-async def handle_stats_command(chat_id: int, user: User):
+async def give_attempts_bulk_command(ctx: UpdateContext, target: str, attempts_text: str):
+    """Bulk grant from /give; the update id makes a redelivered command a no-op"""
+    try:
+        attempts = int(attempts_text)
+        if ':' in target:
+            criterion, value = target.split(':', 1)
+            field_name = {"active": "active_days", "referrals": "min_referrals"}.get(criterion)
+            if field_name is None:
+                raise ValueError(criterion)
+            user_ids, criteria = None, {field_name: int(value)}
+        else:
+            user_ids, criteria = [int(user_id) for user_id in target.split(',') if user_id], None
+    except ValueError:
+        await send_telegram_message(ctx.chat_id, "❌ Неверный формат списка пользователей или фильтра")
+        return
+
+    try:
+        grant = await create_attempt_grant(
+            f"tg:{ctx.update.update_id}", attempts, "bot", user_ids=user_ids, criteria=criteria
+        )
+    except Exception as e:
+        logging.error(f"Bulk give attempts error: {e}")
+        await send_telegram_message(ctx.chat_id, "❌ Ошибка при массовой выдаче попыток")
+        return
+
+    async def run_and_report():
+        try:
+            result = await run_attempt_grant(grant)
+            await send_telegram_message(
+                ctx.chat_id,
+                f"✅ Выдано {attempts} попыток {result['granted']} пользователям "
+                f"(пакетов: {result['batches']})"
+            )
+        except Exception as e:
+            logging.error(f"Bulk give attempts error: {e}")
+            await send_telegram_message(ctx.chat_id, "❌ Ошибка при массовой выдаче попыток")
+
+    # A filter grant can cover thousands of users, so it runs outside the webhook request
+    if grant["status"] != "done":
+        await send_telegram_message(ctx.chat_id, f"⏳ Выдача попыток запущена (id: {grant['_id']})")
+    run_in_background(run_and_report())
+
+@bot_router.command("stats", admin_only=True)
+async def handle_stats_command(ctx: UpdateContext):
     """Handle stats admin command"""
+    chat_id = ctx.chat_id
     try:
         # Get comprehensive statistics
-        total_users = await db.users.count_documents({})
-        total_searches = await db.searches.count_documents({})
-        total_referrals = await db.referrals.count_documents({})
-        successful_searches = await db.searches.count_documents({"success": True})
+        totals = await get_dashboard_totals()
+        total_users = totals["total_users"]
+        total_searches = totals["total_searches"]
+        total_referrals = totals["total_referrals"]
+        successful_searches = totals["successful_searches"]
 
         # Recent activity
-        recent_users = await db.users.count_documents({
-            "created_at": {"$gte": datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)}
-        })
-        recent_searches = await db.searches.count_documents({
-            "timestamp": {"$gte": datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)}
-        })
+        today = await get_analytics_window(floor_day(datetime.utcnow()))
+        recent_users = today["new_users"]
+        recent_searches = today["searches"]
 
         # Search type distribution
-        search_types = await db.searches.aggregate([
-            {"$group": {"_id": "$search_type", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
-        ]).to_list(10)
+        by_type = (await get_analytics_totals())["searches_by_type"]
+        search_types = [
+            {"_id": search_type, "count": count}
+            for search_type, count in sorted(by_type.items(), key=lambda item: -item[1])
+        ]
 
         stats_text = "📊 *═══ ДЕТАЛЬНАЯ СТАТИСТИКА ═══*\n\n"
         
@@ -1191,6 +4266,14 @@ async def handle_stats_command(chat_id: int, user: User):
             for search_type in search_types[:5]:
                 stats_text += f"• {search_type['_id']}: {search_type['count']}\n"
 
+        breaker = usersbox_breaker.stats()
+        stats_text += f"\n🔌 *Usersbox:* {breaker['state']}\n"
+        stats_text += f"• Ошибок: {breaker['error_rate'] * 100:.0f}%\n"
+        if breaker['latency_ms_p95'] is not None:
+            stats_text += f"• p95: {breaker['latency_ms_p95'] / 1000:.1f} с\n"
+        if breaker['state'] == "open":
+            stats_text += f"• Повтор через: {breaker['retry_in_seconds']:.0f} с\n"
+
         await send_telegram_message(chat_id, stats_text)
 
     except Exception as e:
@@ -1204,31 +4287,59 @@ async def handle_stats_command(chat_id: int, user: User):
 @api_router.post("/search")
 async def api_search(query: str = Query(...)):
     """Search via usersbox API"""
-    headers = {"Authorization": USERSBOX_TOKEN}
     try:
-        response = requests.get(
-            f"{USERSBOX_BASE_URL}/search",
-            headers=headers,
-            params={"q": query},
-            timeout=30
-        )
+        response = await usersbox_search(query, user_key="api", priority="batch", wait_timeout=SEARCH_QUEUE_DEADLINE_SECONDS)
         response.raise_for_status()
         return response.json()
+    except (Overloaded, CircuitOpenError) as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except requests.exceptions.RequestException as e:
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
+class SearchJobRequest(BaseModel):
+    query: str
+
+@api_router.post("/search/jobs", status_code=202)
+async def create_search_job(request: SearchJobRequest):
+    """Queue a Usersbox search and return its job id"""
+    query = request.query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    if await search_queue_full():
+        SEARCH_JOB_STATS["refused"] += 1
+        raise HTTPException(status_code=503, detail="Search queue is full", headers={"Retry-After": "30"})
+    job = await submit_search_job(query, "api", is_admin=True)
+    return serialize_search_job(job)
+
+@api_router.get("/search/jobs/{job_id}")
+async def get_search_job(job_id: str):
+    """Get search job status and, once done, its results"""
+    job = await db.search_jobs.find_one({"_id": job_id})
+    if not job:
+        raise HTTPException(status_code=404, detail="Search job not found")
+    result = serialize_search_job(job)
+    if job["status"] == "queued":
+        result["queue_position"] = await search_job_queue_position(job)
+    return result
+
 @api_router.get("/users")
-async def get_users():
+async def get_users(request: Request):
     """Get all users for admin dashboard"""
-    users = await db.users.find().to_list(1000)
+    return await dashboard_cache.respond(request, "users", load_dashboard_users)
+
+async def load_dashboard_users() -> List[Dict[str, Any]]:
+    users = await analytics_db.users.find().to_list(1000)
     for user in users:
         user["_id"] = str(user["_id"])
     return users
 
 @api_router.get("/searches")
-async def get_searches():
+async def get_searches(request: Request):
     """Get search history"""
-    searches = await db.searches.find().sort("timestamp", -1).limit(100).to_list(100)
+    return await dashboard_cache.respond(request, "searches", load_dashboard_searches)
+
+async def load_dashboard_searches() -> List[Dict[str, Any]]:
+    searches = await analytics_db.searches.find().sort("timestamp", -1).limit(100).to_list(100)
     for search in searches:
         search["_id"] = str(search["_id"])
     return searches
@@ -1244,9 +4355,10 @@ async def give_attempts_api(user_id: int, attempts: int):
         
         if result.modified_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
+        dashboard_cache.invalidate("users")
 
         # Notify user
-        await send_telegram_message(
+        await queue_telegram_message(
             user_id,
             f"🎁 *Вам выданы попытки!*\n\n"
             f"💎 Получено попыток: {attempts}\n"
@@ -1257,25 +4369,237 @@ async def give_attempts_api(user_id: int, attempts: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+class GrantCriteria(BaseModel):
+    active_days: Optional[int] = Field(None, ge=1)
+    min_referrals: Optional[int] = Field(None, ge=0)
+
+class BulkGrantRequest(BaseModel):
+    grant_id: str
+    attempts: int
+    user_ids: Optional[List[int]] = None
+    filter: Optional[GrantCriteria] = None
+
+async def start_attempt_grant(
+    grant_id: str, attempts: int, user_ids: Optional[List[int]] = None, criteria: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    if not grant_id.strip():
+        raise HTTPException(status_code=400, detail="grant_id must not be empty")
+    if (user_ids is None) == (criteria is None):
+        raise HTTPException(status_code=400, detail="Specify either user_ids or filter")
+    if criteria is not None and not grant_criteria_query(criteria):
+        raise HTTPException(status_code=400, detail="Filter must have at least one condition")
+    try:
+        grant = await create_attempt_grant(grant_id, attempts, "api", user_ids=user_ids, criteria=criteria)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if grant["status"] != "done":
+        # Re-posting a grant id resumes it if the previous run was interrupted
+        run_in_background(run_attempt_grant(grant))
+    return serialize_attempt_grant(grant)
+
+@api_router.post("/give-attempts/bulk", status_code=202)
+async def give_attempts_bulk_api(request: BulkGrantRequest):
+    """Grant attempts to a list of users or to users matching a filter"""
+    criteria = request.filter.model_dump(exclude_none=True) if request.filter is not None else None
+    return await start_attempt_grant(request.grant_id, request.attempts, request.user_ids, criteria)
+
+@api_router.post("/give-attempts/bulk/csv", status_code=202)
+async def give_attempts_csv_api(grant_id: str = Form(...), attempts: int = Form(...), file: UploadFile = File(...)):
+    """Grant attempts to the telegram ids in the first column of a CSV file"""
+    content = (await file.read()).decode('utf-8-sig')
+    user_ids = []
+    for row in csv.reader(io.StringIO(content)):
+        if row and row[0].strip().lstrip('-').isdigit():
+            user_ids.append(int(row[0].strip()))
+    if not user_ids:
+        raise HTTPException(status_code=400, detail="No telegram ids found in the CSV file")
+    return await start_attempt_grant(grant_id, attempts, user_ids)
+
+@api_router.get("/give-attempts/bulk/{grant_id}")
+async def get_attempt_grant(grant_id: str):
+    """Progress of a bulk grant"""
+    grant = await db.attempt_grants.find_one({"_id": grant_id})
+    if not grant:
+        raise HTTPException(status_code=404, detail="Grant not found")
+    return serialize_attempt_grant(grant)
+
+@api_router.get("/dashboard/stream")
+async def dashboard_stream_api(request: Request):
+    """Server-sent events with stat deltas and new users, searches, referrals and grants"""
+    subscriber = dashboard_events.subscribe(request.headers.get("last-event-id"))
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if subscriber.lagging and subscriber.queue.empty():
+                    # Tell the client to reload /api/stats; it reconnects on its own and
+                    # the id moves it past what it missed so it is not sent here again
+                    yield f"id: {dashboard_events.last_id()}\nevent: resync\ndata: {{}}\n\n"
+                    return
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), DASHBOARD_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield message
+        finally:
+            dashboard_events.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/analytics/window")
+async def analytics_window_api(hours: int = Query(24, ge=1, le=24 * 366)):
+    """Activity totals for the last N hours, summed from rollup buckets"""
+    try:
+        return await get_analytics_window(datetime.utcnow() - timedelta(hours=hours))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/analytics/series")
+async def analytics_series_api(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    days: int = Query(90, ge=1, le=366)
+):
+    """Per-bucket activity series for charting"""
+    try:
+        start = floor_day(datetime.utcnow()) - timedelta(days=days - 1)
+        return await get_analytics_series(granularity, start)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/maintenance/rebuild-analytics")
+async def rebuild_analytics_api():
+    """Recompute analytics rollups from the raw collections"""
+    try:
+        return await rebuild_analytics_buckets()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/maintenance/retention")
+async def retention_api(max_batches: int = Query(10, ge=1, le=1000)):
+    """Run a bounded search retention pass now"""
+    try:
+        return await run_retention_pass(max_batches)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/maintenance/backfill-counters")
+async def backfill_counters_api():
+    """Rebuild per-user search and referral counters from history"""
+    try:
+        return await backfill_user_counters()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def dedupe_referrals() -> Dict[str, int]:
+    """Delete repeated (referrer_id, referred_id) pairs, keeping the earliest one.
+
+    Each removed duplicate had credited both sides an attempt and the
+    referrer a referral, so those are taken back, never below zero.
+    """
+    duplicates = db.referrals.aggregate([
+        {"$sort": {"timestamp": 1}},
+        {"$group": {"_id": {"referrer_id": "$referrer_id", "referred_id": "$referred_id"},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    removed = 0
+    async for row in duplicates:
+        result = await db.referrals.delete_many({"_id": {"$in": row["ids"][1:]}})
+        # Only what this run actually deleted, so a concurrent run cannot take back twice
+        extra = result.deleted_count
+        if not extra:
+            continue
+        removed += extra
+        await db.users.bulk_write([
+            UpdateOne({"telegram_id": row["_id"]["referrer_id"]}, [{"$set": {
+                "attempts_remaining": {"$max": [0, {"$subtract": [{"$ifNull": ["$attempts_remaining", 0]}, extra]}]},
+                "total_referrals": {"$max": [0, {"$subtract": [{"$ifNull": ["$total_referrals", 0]}, extra]}]}
+            }}]),
+            UpdateOne({"telegram_id": row["_id"]["referred_id"]}, [{"$set": {
+                "attempts_remaining": {"$max": [0, {"$subtract": [{"$ifNull": ["$attempts_remaining", 0]}, extra]}]}
+            }}])
+        ], ordered=False)
+    await db.referrals.create_index([("referrer_id", 1), ("referred_id", 1)], unique=True)
+    return {"removed": removed}
+
+@api_router.post("/maintenance/dedupe-referrals")
+async def dedupe_referrals_api():
+    """Remove double-credited referrals and create the unique referral index"""
+    try:
+        result = await dedupe_referrals()
+        if result["removed"]:
+            log_event("maintenance", "Removed duplicate referrals", logging.WARNING, **result)
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Get internal runtime metrics"""
+    return {
+        "logging": get_logging_stats(),
+        "state": {**STATE_STATS, **state_backend.stats()},
+        "update_dedup": DEDUP_STATS,
+        "retention": RETENTION_STATS,
+        "outbox": get_outbox_stats(),
+        "search_jobs": {
+            **SEARCH_JOB_STATS,
+            "queued": await db.search_jobs.count_documents({"status": "queued"})
+        },
+        "usersbox_scheduler": usersbox_scheduler.stats(),
+        "usersbox": {**USERSBOX_STATS, "breaker": usersbox_breaker.stats(), "key_pool": usersbox_keys.stats()},
+        "flood": FLOOD_STATS,
+        "admission": get_saturation(),
+        "dashboard_stream": dashboard_events.stats(),
+        "dashboard_cache": dashboard_cache.stats()
+    }
+
+def get_saturation() -> Dict[str, Any]:
+    """In-memory saturation of each dependency bulkhead, cheap enough to poll"""
+    usersbox = usersbox_scheduler.stats()
+    return {
+        "usersbox": {key: value for key, value in usersbox.items() if key != "classes"},
+        "telegram": telegram_bulkhead.stats(),
+        "mongo": mongo_bulkhead.stats(),
+        "search_workers_busy": SEARCH_JOB_STATS["running"] / SEARCH_WORKER_CONCURRENCY
+    }
+
+@api_router.get("/saturation")
+async def get_saturation_api():
+    """Saturation levels for autoscaling decisions"""
+    return get_saturation()
+
 @api_router.get("/stats")
-async def get_stats():
+async def get_stats(request: Request):
     """Get bot statistics"""
     try:
-        total_users = await db.users.count_documents({})
-        total_searches = await db.searches.count_documents({})
-        total_referrals = await db.referrals.count_documents({})
-        successful_searches = await db.searches.count_documents({"success": True})
-
-        return {
-            "total_users": total_users,
-            "total_searches": total_searches,
-            "total_referrals": total_referrals,
-            "successful_searches": successful_searches,
-            "success_rate": (successful_searches / total_searches * 100) if total_searches > 0 else 0
-        }
+        return await dashboard_cache.respond(request, "stats", load_dashboard_stats)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def load_dashboard_stats() -> Dict[str, Any]:
+    totals = await get_dashboard_totals()
+    total_users = totals["total_users"]
+    total_searches = totals["total_searches"]
+    total_referrals = totals["total_referrals"]
+    successful_searches = totals["successful_searches"]
+
+    return {
+        "total_users": total_users,
+        "total_searches": total_searches,
+        "total_referrals": total_referrals,
+        "successful_searches": successful_searches,
+        "success_rate": (successful_searches / total_searches * 100) if total_searches > 0 else 0,
+        "usersbox_breaker": usersbox_breaker.stats()
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1287,13 +4611,83 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+@app.middleware("http")
+async def track_request_time(request: Request, call_next):
+    started = time.perf_counter_ns()
+    try:
+        return await call_next(request)
+    finally:
+        LOG_STATS["requests"] += 1
+        LOG_STATS["request_ns"] += time.perf_counter_ns() - started
+
+@app.on_event("startup")
+async def ensure_indexes():
+    await db.processed_updates.create_index("update_id", unique=True)
+    await db.processed_updates.create_index("created_at", expireAfterSeconds=UPDATE_DEDUP_TTL_SECONDS)
+    try:
+        await db.referrals.create_index([("referrer_id", 1), ("referred_id", 1)], unique=True)
+    except Exception as e:
+        # Double-credited referrals from before the index make its creation fail
+        logging.error(
+            f"Unique referral index not created, referrals may be double-credited; "
+            f"run /api/maintenance/dedupe-referrals: {e}"
+        )
+    await db.users.create_index("telegram_id")
+    await db.users.create_index("referral_code")
+    await db.analytics_buckets.create_index([("granularity", 1), ("start", 1)])
+    await db.searches.create_index("timestamp")
+    await db.searches.create_index("success")
+    await db.searches_archive.create_index("success")
+    # Payload purging only walks searches that still carry results
+    await db.searches.create_index(
+        [("timestamp", 1), ("_id", 1)], partialFilterExpression={"results": {"$exists": True}}
+    )
+    await db.searches_archive.create_index([("user_id", 1), ("timestamp", -1)])
+    await db.outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.outbox.create_index("claim_id", sparse=True)
+    await db.outbox.create_index("completed_at", expireAfterSeconds=OUTBOX_DONE_TTL_SECONDS)
+    await db.search_jobs.create_index([("status", 1), ("priority", 1), ("fair_seq", 1), ("created_at", 1)])
+    await db.search_jobs.create_index([("user_id", 1), ("status", 1)])
+    await db.search_jobs.create_index("finished_at", expireAfterSeconds=SEARCH_JOB_TTL_SECONDS)
+    await db.attempt_grant_batches.create_index("grant_id")
+    await db.attempt_grant_credits.create_index([("grant_id", 1), ("telegram_id", 1)], unique=True)
+
+@app.on_event("startup")
+async def start_outbox_dispatcher():
+    run_in_background(outbox_dispatcher())
+
+@app.on_event("startup")
+async def start_search_workers():
+    for _ in range(SEARCH_WORKER_CONCURRENCY):
+        run_in_background(search_worker())
+
+@app.on_event("startup")
+async def start_usersbox_balance_checks():
+    if USERSBOX_BALANCE_REFRESH_SECONDS > 0:
+        run_in_background(usersbox_balance_loop())
+
+@app.on_event("startup")
+async def start_dashboard_stream():
+    if DASHBOARD_EVENT_SOURCE != "local":
+        run_in_background(dashboard_events.watch_changes())
+
+@app.on_event("startup")
+async def start_analytics_backfill():
+    # A deployment that predates the rollups has no total bucket yet
+    if await db.analytics_buckets.find_one({"_id": "total"}, {"_id": 1}) is None \
+            and await db.users.estimated_document_count() > 0:
+        run_in_background(backfill_analytics_buckets())
+
+@app.on_event("startup")
+async def start_retention():
+    if RETENTION_ENABLED:
+        run_in_background(retention_loop())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+    analytics_client.close()
+
+@app.on_event("shutdown")
+async def shutdown_logging():
+    log_listener.stop()
\ No newline at end of file
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the bot's hot-path record types
+Compares the slotted records in backend/server.py with the pydantic models they replaced:
+time and allocations for loading a user per update, and for serializing a search and a referral.
+"""
+
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+import server  # noqa: E402
+
+ROUNDS = 20000
+
+# Pydantic models as they were used before the slotted records
+class PydanticUser(BaseModel):
+    telegram_id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    attempts_remaining: int = 0
+    referred_by: Optional[int] = None
+    referral_code: str
+    total_referrals: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    is_admin: bool = False
+    last_active: datetime = Field(default_factory=datetime.utcnow)
+    is_subscribed: bool = False
+    total_searches: int = 0
+    successful_searches: int = 0
+    referrals_earned: int = 0
+    recent_searches: List[Dict[str, Any]] = Field(default_factory=list)
+
+class PydanticSearch(BaseModel):
+    user_id: int
+    query: str
+    search_type: str
+    results: Dict[str, Any]
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    attempt_used: bool = True
+    success: bool = True
+
+class PydanticReferral(BaseModel):
+    referrer_id: int
+    referred_id: int
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    attempt_given: bool = True
+
+USER_DOCUMENT = {
+    "_id": "65f0c0ffee",
+    "telegram_id": 123456789,
+    "username": "ivan",
+    "first_name": "Иван",
+    "last_name": "Петров",
+    "attempts_remaining": 3,
+    "referred_by": None,
+    "referral_code": "a1b2c3d4",
+    "total_referrals": 2,
+    "created_at": datetime.utcnow(),
+    "is_admin": False,
+    "last_active": datetime.utcnow(),
+    "is_subscribed": True,
+    "total_searches": 14,
+    "successful_searches": 9,
+    "referrals_earned": 2,
+    "recent_searches": [
+        {"query": "+79123456789", "search_type": "phone", "success": True, "timestamp": datetime.utcnow()}
+    ] * 3
+}
+
+RESULTS = {"status": "success", "data": {"count": 25, "items": [
+    {
+        "source": {"database": "vk", "collection": f"users_{index}"},
+        "hits": {"hitsCount": 5, "items": [{"full_name": "Иван Петров", "phone": "79123456789", "city": "Москва"}] * 5}
+    }
+    for index in range(5)
+]}}
+
+def load_user_pydantic():
+    return PydanticUser(**USER_DOCUMENT)
+
+def load_user_record():
+    return server.User.from_document(USER_DOCUMENT)
+
+def dump_search_pydantic():
+    return PydanticSearch(user_id=1, query="ivan", search_type="name", results=RESULTS, success=True).dict()
+
+def dump_search_record():
+    return server.Search(user_id=1, query="ivan", search_type="name", results=RESULTS, success=True).to_document()
+
+def dump_referral_pydantic():
+    return PydanticReferral(referrer_id=1, referred_id=2).dict()
+
+def dump_referral_record():
+    return server.Referral(referrer_id=1, referred_id=2).to_document()
+
+def measure(func) -> Dict[str, float]:
+    per_call_us = min(timeit.repeat(func, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [func() for _ in range(1000)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    allocated = sum(stat.size_diff for stat in stats) / len(kept)
+    return {"us": per_call_us, "bytes": allocated}
+
+def main():
+    import warnings
+    warnings.simplefilter("ignore")
+    cases = [
+        ("load user per update", load_user_pydantic, load_user_record),
+        ("serialize search", dump_search_pydantic, dump_search_record),
+        ("serialize referral", dump_referral_pydantic, dump_referral_record),
+    ]
+    print(f"{'case':24} {'pydantic':>22} {'record':>22} {'speedup':>8}")
+    for name, baseline, fast in cases:
+        old, new = measure(baseline), measure(fast)
+        print(
+            f"{name:24} {old['us']:8.2f} us {old['bytes']:7.0f} B "
+            f"{new['us']:8.2f} us {new['bytes']:7.0f} B {old['us'] / new['us']:7.1f}x"
+        )
+
+if __name__ == "__main__":
+    main()
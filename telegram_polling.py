@@ -16,6 +16,7 @@ load_dotenv('/app/backend/.env')
 
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
 WEBHOOK_URL = f"http://localhost:8001/api/webhook/{os.environ['WEBHOOK_SECRET']}"
+OFFSET_FILE = os.environ.get('POLLING_OFFSET_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.telegram_offset'))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,6 +35,24 @@ def get_updates(offset=None):
         logger.error(f"Error getting updates: {e}")
         return None
 
+def load_offset():
+    """Load the last confirmed offset so a restart does not replay updates"""
+    try:
+        with open(OFFSET_FILE) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def save_offset(offset):
+    """Persist the offset atomically"""
+    tmp_file = f"{OFFSET_FILE}.tmp"
+    try:
+        with open(tmp_file, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_file, OFFSET_FILE)
+    except OSError as e:
+        logger.error(f"Error saving offset: {e}")
+
 def process_update(update):
     """Send update to webhook"""
     try:
@@ -49,7 +68,8 @@ def main():
     """Main polling loop"""
     logger.info("Starting Telegram bot polling...")
     logger.info(f"Webhook URL: {WEBHOOK_URL}")
-    offset = None
+    offset = load_offset()
+    logger.info(f"Starting from offset: {offset}")
     
     while True:
         try:
@@ -64,6 +84,7 @@ def main():
             for update in updates:
                 process_update(update)
                 offset = update['update_id'] + 1
+                save_offset(offset)
             
             if not updates:
                 time.sleep(1)
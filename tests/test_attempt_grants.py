@@ -0,0 +1,126 @@
+"""Idempotency of bulk attempt grants: re-runs, interrupted runs and concurrent runs."""
+
+import asyncio
+import sys
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+USER_IDS = [101, 102, 103]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = mongomock_motor.AsyncMongoMockClient()[f"grants_{uuid.uuid4().hex}"]
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "BULK_GRANT_CHUNK_SIZE", 2)
+
+    async def prepare():
+        await database.attempt_grant_credits.create_index([("grant_id", 1), ("telegram_id", 1)], unique=True)
+        await database.users.insert_many([{"telegram_id": user_id, "attempts_remaining": 0} for user_id in USER_IDS])
+
+    asyncio.run(prepare())
+    return database
+
+
+async def balances(db):
+    return {user["telegram_id"]: user["attempts_remaining"] async for user in db.users.find()}
+
+
+def test_rerun_of_a_finished_grant_credits_nobody_again(db):
+    async def scenario():
+        grant = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        await server.run_attempt_grant(grant)
+        again = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        result = await server.run_attempt_grant(again)
+        assert result["status"] == "done" and result["granted"] == len(USER_IDS)
+        assert await balances(db) == {user_id: 5 for user_id in USER_IDS}
+        assert await db.outbox.count_documents({}) == len(USER_IDS)
+
+    asyncio.run(scenario())
+
+
+def test_conflicting_parameters_are_rejected(db):
+    async def scenario():
+        await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        with pytest.raises(ValueError):
+            await server.create_attempt_grant("g1", 6, "api", user_ids=USER_IDS)
+
+    asyncio.run(scenario())
+
+
+def test_interrupted_run_resumes_without_double_credit(db):
+    async def scenario():
+        grant = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        # The previous runner claimed credits for the first chunk, incremented user 101
+        # and crashed before marking the credits applied
+        now = datetime.utcnow()
+        await db.attempt_grant_credits.insert_many([
+            {"grant_id": "g1", "telegram_id": user_id, "attempts": 5, "applied": False, "created_at": now}
+            for user_id in USER_IDS[:2]
+        ])
+        await db.users.update_one(
+            {"telegram_id": 101}, {"$inc": {"attempts_remaining": 5}, "$addToSet": {"pending_grants": "g1"}}
+        )
+        await db.attempt_grants.update_one(
+            {"_id": "g1"}, {"$set": {"lease_owner": "crashed", "lease_expires_at": now - timedelta(seconds=1)}}
+        )
+
+        result = await server.run_attempt_grant(grant)
+        assert result["status"] == "done"
+        assert await balances(db) == {user_id: 5 for user_id in USER_IDS}
+        assert await db.users.count_documents({"pending_grants": "g1"}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_runs_credit_each_user_once(db):
+    async def scenario():
+        grant = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        retried = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        await asyncio.gather(server.run_attempt_grant(grant), server.run_attempt_grant(retried))
+        assert await balances(db) == {user_id: 5 for user_id in USER_IDS}
+        assert (await db.attempt_grants.find_one({"_id": "g1"}))["status"] == "done"
+
+    asyncio.run(scenario())
+
+
+def test_live_lease_keeps_a_second_runner_out(db):
+    async def scenario():
+        grant = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        assert await server.claim_attempt_grant("g1", "other-runner")
+        result = await server.run_attempt_grant(grant)
+        assert result["status"] == "running" and result["lease_owner"] == "other-runner"
+        assert await balances(db) == {user_id: 0 for user_id in USER_IDS}
+
+    asyncio.run(scenario())
+
+
+def test_lost_lease_stops_the_runner(db):
+    async def scenario():
+        grant = await server.create_attempt_grant("g1", 5, "api", user_ids=USER_IDS)
+        original = server.apply_grant_batch
+
+        async def apply_then_lose_lease(*args, **kwargs):
+            granted = await original(*args, **kwargs)
+            await db.attempt_grants.update_one({"_id": "g1"}, {"$set": {"lease_owner": "other-runner"}})
+            return granted
+
+        server.apply_grant_batch = apply_then_lose_lease
+        try:
+            await server.run_attempt_grant(grant)
+        finally:
+            server.apply_grant_batch = original
+        # Only the first chunk was applied; the new owner finishes the rest
+        assert await balances(db) == {101: 5, 102: 5, 103: 0}
+        assert (await db.attempt_grants.find_one({"_id": "g1"}))["status"] == "running"
+
+    asyncio.run(scenario())
@@ -0,0 +1,141 @@
+"""State backend tests.
+
+Runs against the in-memory backend, against fakeredis when it is installed
+and against a real Redis when TEST_REDIS_URL is set.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+
+def memory_backend():
+    return server.MemoryStateBackend()
+
+
+def fakeredis_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # EVAL support for the Lua scripts
+    return server.RedisStateBackend(fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+def redis_backend():
+    url = os.environ.get("TEST_REDIS_URL")
+    if not url or server.aioredis is None:
+        pytest.skip("TEST_REDIS_URL is not set")
+    return server.RedisStateBackend(server.aioredis.from_url(url, decode_responses=True))
+
+
+@pytest.fixture(params=[memory_backend, fakeredis_backend, redis_backend], ids=["memory", "fakeredis", "redis"])
+def backend(request):
+    return request.param()
+
+
+@pytest.fixture
+def key():
+    # Unique per test so a shared Redis needs no cleanup
+    return f"test:{uuid.uuid4().hex}"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_get_set_and_expiry(backend, key):
+    async def scenario():
+        assert await backend.get(key) is None
+        await backend.set(key, "value", ttl=0.2)
+        assert await backend.get(key) == "value"
+        await asyncio.sleep(0.3)
+        assert await backend.get(key) is None
+
+    run(scenario())
+
+
+def test_set_if_absent(backend, key):
+    async def scenario():
+        assert await backend.set_if_absent(key, "first", ttl=5)
+        assert not await backend.set_if_absent(key, "second", ttl=5)
+        assert await backend.get(key) == "first"
+        await backend.delete(key)
+        assert await backend.set_if_absent(key, "third", ttl=5)
+
+    run(scenario())
+
+
+def test_incr_keeps_the_first_ttl(backend, key):
+    async def scenario():
+        assert await backend.incr(key, ttl=0.3) == 1
+        await asyncio.sleep(0.2)
+        # A later increment must not push the expiry out
+        assert await backend.incr(key, 2, ttl=0.3) == 3
+        await asyncio.sleep(0.2)
+        assert await backend.get(key) is None
+
+    run(scenario())
+
+
+def test_release_only_deletes_own_token(backend, key):
+    async def scenario():
+        await backend.set(key, "mine", ttl=5)
+        await backend.release(key, "theirs")
+        assert await backend.get(key) == "mine"
+        await backend.release(key, "mine")
+        assert await backend.get(key) is None
+
+    run(scenario())
+
+
+def test_take_token_allows_burst_then_refills(backend, key):
+    async def scenario():
+        assert [await backend.take_token(key, 5, 2) for _ in range(3)] == [True, True, False]
+        await asyncio.sleep(0.3)
+        assert await backend.take_token(key, 5, 2)
+
+    run(scenario())
+
+
+def test_lease_is_exclusive(backend, key):
+    async def scenario():
+        async with backend.lease(key, ttl=5, wait=0.1) as first:
+            async with backend.lease(key, ttl=5, wait=0.1) as second:
+                assert first and not second
+        # Released on exit, so the next caller gets it at once
+        async with backend.lease(key, ttl=5, wait=0) as third:
+            assert third
+
+    run(scenario())
+
+
+def test_memory_backend_is_bounded():
+    async def scenario():
+        backend = server.MemoryStateBackend(max_keys=10)
+        for index in range(25):
+            await backend.set(f"key:{index}", "value")
+        assert len(backend.values) <= 10
+        assert await backend.get("key:24") == "value"
+
+    run(scenario())
+
+
+def test_key_pool_quota_is_shared_between_replicas(backend, monkeypatch):
+    monkeypatch.setattr(server, "USERSBOX_KEY_MAX_WAIT_SECONDS", 0)
+    token = uuid.uuid4().hex
+
+    async def scenario():
+        first = server.UsersboxKeyPool([token], "least_loaded", 0.01, 2, backend)
+        second = server.UsersboxKeyPool([token], "least_loaded", 0.01, 2, backend)
+        await first.acquire()
+        await second.acquire()
+        with pytest.raises(server.Overloaded):
+            await first.acquire()
+
+    run(scenario())
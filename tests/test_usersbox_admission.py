@@ -0,0 +1,273 @@
+"""Admission control around Usersbox: circuit breaker, hedging, the fair scheduler and bulkheads."""
+
+import asyncio
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def breaker(**overrides):
+    settings = dict(
+        window=4, min_calls=4, error_rate=0.5, slow_call_seconds=1.0, slow_call_rate=0.75, open_seconds=0.2
+    )
+    settings.update(overrides)
+    return server.CircuitBreaker("test", **settings)
+
+
+# Circuit breaker
+
+def test_breaker_trips_on_error_rate():
+    circuit = breaker()
+    for failed in (False, True, False, True):
+        circuit.before_call()
+        circuit.record(failed, 0.01)
+    assert circuit.state == "open" and circuit.trips == 1
+    with pytest.raises(server.CircuitOpenError):
+        circuit.before_call()
+    assert circuit.rejected == 1
+
+
+def test_breaker_trips_on_slow_calls():
+    circuit = breaker()
+    for _ in range(4):
+        circuit.before_call()
+        circuit.record(False, 2.0)
+    assert circuit.state == "open"
+
+
+def test_breaker_half_open_allows_one_probe_and_closes_on_success():
+    circuit = breaker()
+    circuit._trip()
+    assert not circuit.available()
+    time.sleep(0.25)
+    assert circuit.available()
+    circuit.before_call()
+    assert circuit.state == "half_open"
+    # Only one probe at a time
+    with pytest.raises(server.CircuitOpenError):
+        circuit.before_call()
+    circuit.record(False, 0.01)
+    assert circuit.state == "closed"
+
+
+def test_breaker_failed_probe_reopens():
+    circuit = breaker()
+    circuit._trip()
+    time.sleep(0.25)
+    circuit.before_call()
+    circuit.record(True, 0.01)
+    assert circuit.state == "open" and circuit.trips == 2
+
+
+def test_breaker_abandoned_probe_frees_the_half_open_slot():
+    circuit = breaker()
+    circuit._trip()
+    time.sleep(0.25)
+    circuit.before_call()
+    circuit.abandon()
+    # The next caller may probe instead
+    circuit.before_call()
+    assert circuit.state == "half_open" and circuit.probe_in_flight
+
+
+# Hedged requests
+
+@pytest.fixture
+def hedging(monkeypatch):
+    scheduler = server.UsersboxScheduler(2, 10)
+    keys = server.UsersboxKeyPool([uuid.uuid4().hex], "least_loaded", 1000, 1000, server.MemoryStateBackend())
+    circuit = breaker()
+    # A p95 of 10ms, so the hedge fires almost at once
+    circuit.latencies.extend([0.01] * 20)
+    monkeypatch.setattr(server, "usersbox_scheduler", scheduler)
+    monkeypatch.setattr(server, "usersbox_keys", keys)
+    monkeypatch.setattr(server, "usersbox_breaker", circuit)
+    monkeypatch.setattr(server, "USERSBOX_HEDGE_ENABLED", True)
+    monkeypatch.setattr(server, "USERSBOX_HEDGE_MIN_DELAY_SECONDS", 0.01)
+    return scheduler, keys
+
+
+def in_flight(keys):
+    return sum(key.in_flight for key in keys.keys)
+
+
+def test_hedge_releases_slot_and_key_only_after_the_loser_ends(hedging, monkeypatch):
+    scheduler, keys = hedging
+    calls = []
+    loser_may_finish = threading.Event()
+
+    def fetch(url, token, query, array_caps):
+        calls.append(query)
+        if len(calls) == 1:
+            # The primary is slow; the hedge answers first
+            loser_may_finish.wait(5)
+            return server.UsersboxResponse(200, {}, {"data": "primary"})
+        return server.UsersboxResponse(200, {}, {"data": "hedge"})
+
+    monkeypatch.setattr(server, "fetch_usersbox", fetch)
+
+    async def scenario():
+        await scheduler.acquire("user", 0)
+        response = await server.hedged_usersbox_get("query")
+        assert response.payload == {"data": "hedge"}
+        # The primary still runs in its thread, so its key and the hedge slot stay taken
+        assert scheduler.active == 2 and in_flight(keys) == 1
+        loser_may_finish.set()
+        for _ in range(100):
+            if in_flight(keys) == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert in_flight(keys) == 0 and scheduler.active == 1
+        scheduler.release()
+
+    run(scenario())
+    assert server.USERSBOX_STATS["hedge_wins"] >= 1
+
+
+def test_no_hedge_when_the_scheduler_is_full(hedging, monkeypatch):
+    scheduler, keys = hedging
+    calls = []
+
+    def fetch(url, token, query, array_caps):
+        calls.append(query)
+        time.sleep(0.1)
+        return server.UsersboxResponse(200, {}, {"data": "primary"})
+
+    monkeypatch.setattr(server, "fetch_usersbox", fetch)
+
+    async def scenario():
+        await scheduler.acquire("user", 0)
+        await scheduler.acquire("other", 0)
+        response = await server.hedged_usersbox_get("query")
+        assert response.payload == {"data": "primary"} and len(calls) == 1
+        assert scheduler.active == 2 and in_flight(keys) == 0
+
+    run(scenario())
+
+
+# Fair scheduler
+
+def test_scheduler_round_robins_between_users():
+    async def scenario():
+        scheduler = server.UsersboxScheduler(1, 10)
+        await scheduler.acquire("busy", 0)
+        order = []
+
+        async def wait(key):
+            await scheduler.acquire(key, 0)
+            order.append(key)
+
+        # One user queues three searches before another queues one
+        tasks = [asyncio.ensure_future(wait(key)) for key in ("heavy", "heavy", "heavy", "light")]
+        await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ["heavy", "light", "heavy", "heavy"]
+
+    run(scenario())
+
+
+def test_scheduler_serves_higher_priority_first():
+    async def scenario():
+        scheduler = server.UsersboxScheduler(1, 10)
+        await scheduler.acquire("busy", 0)
+        order = []
+
+        async def wait(key, priority):
+            await scheduler.acquire(key, priority)
+            order.append(key)
+
+        tasks = [
+            asyncio.ensure_future(wait("batch", server.SEARCH_PRIORITIES["batch"])),
+            asyncio.ensure_future(wait("chat", server.SEARCH_PRIORITIES["interactive"]))
+        ]
+        await asyncio.sleep(0)
+        for _ in tasks:
+            scheduler.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ["chat", "batch"]
+
+    run(scenario())
+
+
+def test_scheduler_sheds_after_the_wait_timeout():
+    async def scenario():
+        scheduler = server.UsersboxScheduler(1, 10)
+        await scheduler.acquire("busy", 0)
+        with pytest.raises(server.Overloaded):
+            await scheduler.acquire("late", 0, timeout=0.05)
+        assert scheduler.queued() == 0 and scheduler.shed == 1
+
+    run(scenario())
+
+
+# Bulkheads
+
+def test_bulkhead_sheds_when_the_queue_is_full_or_the_wait_expires():
+    async def scenario():
+        bulkhead = server.Bulkhead("test", 1, 1, 0.05)
+        await bulkhead.acquire()
+        waiter = asyncio.ensure_future(bulkhead.acquire())
+        await asyncio.sleep(0)
+        # The only queue place is taken
+        with pytest.raises(server.Overloaded):
+            await bulkhead.acquire()
+        with pytest.raises(server.Overloaded):
+            await waiter
+        assert bulkhead.stats()["queued"] == 0 and bulkhead.shed == 2
+
+    run(scenario())
+
+
+def test_bulkhead_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        bulkhead = server.Bulkhead("test", 1, 5, 5)
+        await bulkhead.acquire()
+        waiter = asyncio.ensure_future(bulkhead.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert bulkhead.stats()["queued"] == 0
+        bulkhead.release()
+        assert bulkhead.active == 0
+
+    run(scenario())
+
+
+def test_bulkhead_slot_granted_during_cancellation_is_returned():
+    async def scenario():
+        bulkhead = server.Bulkhead("test", 1, 5, 5)
+        await bulkhead.acquire()
+        waiter = asyncio.ensure_future(bulkhead.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed over and the waiter cancelled before it resumes
+        bulkhead.release()
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            assert bulkhead.active == 0
+        else:
+            # Before Python 3.12 wait_for lets the grant win; the caller then owns the slot
+            assert bulkhead.active == 1
+            bulkhead.release()
+        async with bulkhead.slot(timeout=0.05):
+            assert bulkhead.active == 1
+
+    run(scenario())